@@ -46,6 +46,8 @@ import pickle
 import cv2
 import utils
 import logger
+import staging
+import samplers
 
 from google.colab.patches import cv2_imshow
 from PIL import Image
@@ -180,10 +182,7 @@ class BalancingGAN:
         plt.show()
 
     def generate_latent(self, c, bg=None, n_mix=10):  # c is a vector of classes
-        return np.array([
-            np.random.multivariate_normal(self.means[e], self.covariances[e])
-            for e in c
-        ])
+        return self.latent_sampler.sample(c)
 
 
     def gen_for_class(self, bg, classid,size=1000):
@@ -307,20 +306,9 @@ class BalancingGAN:
         )
 
     def _biased_sample_labels(self, samples, target_distribution="uniform"):
-        distribution = self.class_uratio
-        if target_distribution == "d":
-            distribution = self.class_dratio
-        elif target_distribution == "g":
-            distribution = self.class_gratio
-            
-        sampled_labels = np.full(samples,0)
-        sampled_labels_p = np.random.normal(0, 1, samples)
-        for c in list(range(self.nclasses)):
-            mask = np.logical_and((sampled_labels_p > 0), (sampled_labels_p <= distribution[c]))
-            sampled_labels[mask] = self.classes[c]
-            sampled_labels_p = sampled_labels_p - distribution[c]
-
-        return sampled_labels
+        sampler = self.label_samplers.get(target_distribution,
+                                          self.label_samplers['uniform'])
+        return sampler.sample(samples)
 
     def _train_one_epoch(self, bg_train):
         epoch_disc_loss = []
@@ -402,6 +390,14 @@ class BalancingGAN:
             self.class_dratio[self.class_dratio < 0] = 0
             self.class_dratio = self.class_dratio / sum(self.class_dratio)
 
+        # label samplers of every ratio, used by _biased_sample_labels
+        self.label_samplers = {
+            name: samplers.AliasSampler(ratio, self.classes)
+            for name, ratio in [('uniform', self.class_uratio),
+                                ('d', self.class_dratio),
+                                ('g', self.class_gratio)]
+        }
+
     def init_autoenc(self, bg_train, gen_fname=None, rec_fname=None):
         if gen_fname is None:
             generator_fname = "{}/{}_decoder.h5".format(self.res_dir, self.target_class_id)
@@ -463,7 +459,7 @@ class BalancingGAN:
             self.means = []
 
             for c in range(self.nclasses):
-                imgs = bg_train.dataset_x[bg_train.per_class_ids[c]]
+                imgs = bg_train.get_images(bg_train.per_class_ids[c])
                 latent = self.reconstructor.predict(imgs)
 
                 self.covariances.append(np.cov(np.transpose(latent)))
@@ -480,6 +476,8 @@ class BalancingGAN:
             np.save(mfname, self.means)
             print("BAGAN: saved multivariate")
 
+        self.latent_sampler = samplers.LatentSampler(self.means, self.covariances)
+
 
     def _get_lst_bck_name(self, element):
         # Find last bck name
@@ -502,8 +500,10 @@ class BalancingGAN:
 
         # Load last bck
         try:
-            self.generator.load_weights(os.path.join(self.res_dir, generator_fname))
-            self.discriminator.load_weights(os.path.join(self.res_dir, discriminator_fname))
+            self.generator.load_weights(
+                staging.fetch(os.path.join(self.res_dir, generator_fname)))
+            self.discriminator.load_weights(
+                staging.fetch(os.path.join(self.res_dir, discriminator_fname)))
             print('GAN weight initialized, train from epoch ', epoch)
             return epoch
 
@@ -521,8 +521,10 @@ class BalancingGAN:
         generator_fname = "{}/bck_generator.h5".format(self.res_dir)
         discriminator_fname = "{}/bck_discriminator.h5".format(self.res_dir)
 
-        self.generator.save(generator_fname)
-        self.discriminator.save(discriminator_fname)
+        self.generator.save(staging.write_path(generator_fname))
+        self.discriminator.save(staging.write_path(discriminator_fname))
+        staging.push(generator_fname)
+        staging.push(discriminator_fname)
 
 
     def train(self, bg_train, bg_test, epochs=50):
@@ -590,7 +592,7 @@ class BalancingGAN:
                     generated_images = self.generator.predict(
                         latent_gen, verbose=False)
                 
-                    X = np.concatenate( (bg_test.dataset_x, generated_images) )
+                    X = np.concatenate( (bg_test.get_images(), generated_images) )
                     aux_y = np.concatenate((bg_test.dataset_y, np.full(len(sampled_labels), self.nclasses )), axis=0)
                 
                     # see if the discriminator can figure itself out...
@@ -1,6 +1,12 @@
+import json
+import hashlib
+import logger
 import utils
+import ds_store
+import staging
+import samplers
 import numpy as np
-from collections import Counter
+import tensorflow as tf
 from const import CATEGORIES_MAP, INVERT_CATEGORIES_MAP, BASE_DIR
 from sklearn.utils import class_weight as sk_weight
 
@@ -18,66 +24,151 @@ class BatchGenerator:
         dataset='MNIST',
         rst=64,
         prune_classes=None,
+        keep_uint8=False,
+        shared_name=None,
+        class_distribution=None,
     ):
+        """
+        keep_uint8: keep the images as uint8 in memory and normalize them to
+                    float32 only when a batch is taken. The split is then an
+                    index view into the dataset shared by the whole process
+        shared_name: name of a shared memory segment holding the split. If the
+                     segment exists the generator attaches to it instead of
+                     loading the dataset, else the loaded split is published
+                     under this name for the other processes of the host
+        class_distribution: target class distribution of the batches, see
+                            samplers.EpochPlan. None keeps a uniform shuffle
+        """
         self.batch_size = batch_size
         self.data_src = data_src
+        self.keep_uint8 = keep_uint8
+        self.class_distribution = class_distribution
+        # rows of self._x used by this generator, None for all rows
+        self._rows = None
+        self._shared = None
+        # (store, resolution) of the image block the split is read from and
+        # its rows in that block, the block is only hashed by fingerprint
+        self._source = None
+        self._source_rows = None
+
+        if shared_name is not None and not ds_store.HAS_SHARED_MEMORY:
+            logger.warn('Shared memory needs python 3.8, {} is not shared'.format(
+                shared_name))
+            shared_name = None
+        if shared_name is not None and ds_store.SharedArrays.exists(shared_name):
+            self._attach(shared_name)
+            return
 
         if dataset == 'chest':
             if self.data_src == self.TEST:
                 x, y = utils.load_test_data(rst)
-                self.dataset_x = x
+                self._x = x
                 self.dataset_y = y
+                opt = 'test'
 
             else:
                 x, y = utils.load_train_data(rst)
-                self.dataset_x = x  
+                self._x = x  
                 self.dataset_y = y
+                opt = 'train'
+            self._source = (ds_store.DatasetStore(
+                staging.fetch(utils.chest_store_path(opt))), rst)
 
         elif dataset == 'flowers':
-            x, y = utils.pickle_load(BASE_DIR + '/dataset/flowers/imgs_labels.pkl')
+            store, x = ds_store.load_shared(BASE_DIR + '/dataset/flowers/imgs_labels.pkl')
+            self._source = (store, None)
             to_train_classes = self.to_train_classes
             to_test_classes = self.to_test_classes
 
             if self.data_src == self.TEST:
-                to_keep = np.array([i for i, l in enumerate(y) if l in to_test_classes])
-                x, y = x[to_keep], y[to_keep]
-                self.dataset_x = x
+                self._rows = store.ids_for(to_test_classes)
+                self._x = x
                 # TODO start from 0
-                self.dataset_y = y
+                self.dataset_y = store.labels[self._rows]
             else:
-                to_keep = np.array([i for i, l in enumerate(y) if l in to_train_classes])
-                x, y = x[to_keep], y[to_keep]
-                self.dataset_x = x
+                self._rows = store.ids_for(to_train_classes)
+                self._x = x
                 # TODO start from 0
-                self.dataset_y = y
+                self.dataset_y = store.labels[self._rows]
 
 
         else: # multi chest
-            x, y = utils.pickle_load(BASE_DIR + '/dataset/multi_chest/imgs_labels_{}.pkl'.format(rst))
-            to_train_classes = self.to_train_classes
-            to_test_classes = self.to_test_classes
-
-            to_keep = [i for i, l in enumerate(y) if '|' not in l]
-            to_keep = np.array(to_keep)
-            x = x[to_keep]
-            y = y[to_keep]
-            if self.data_src == self.TEST:
-                to_keep = np.array([i for i, l in enumerate(y) if l not in to_train_classes])
-                if len(to_keep) > 0:
-                    x, y = x[to_keep], y[to_keep]
-                self.dataset_x = x
-                self.dataset_y = np.array([CATEGORIES_MAP[l] for l in y])
+            store, x = ds_store.load_shared(
+                BASE_DIR + '/dataset/multi_chest/imgs_labels_{}.pkl'.format(rst), rst)
+            self._rows = self._multi_chest_ids(store)
+            self._x = x
+            self.dataset_y = np.array([CATEGORIES_MAP[l] for l in store.labels[self._rows]])
+            self._source = (store, rst)
+
+        self._source_rows = self._rows
+        # Normalize between -1 and 1, later in get_images for uint8 mode
+        if self.keep_uint8:
+            self._x = np.asarray(self._x, dtype=np.uint8)
+        else:
+            if self._rows is None:
+                self._x = utils.normalize(self._x)
             else:
-                to_keep = np.array([i for i, l in enumerate(y) if l in to_train_classes])
-                x, y = x[to_keep], y[to_keep]
-                self.dataset_x = x
-                self.dataset_y = np.array([CATEGORIES_MAP[l] for l in y])
-
-        # Normalize between -1 and 1
-        self.dataset_x = (self.dataset_x - 127.5) / 127.5
+                self._x = utils.take_normalized(self._x, self._rows)
+                self._rows = None
+
+        self._init_classes(prune_classes)
+        if shared_name is not None:
+            self.share(shared_name)
+
+    def share(self, name):
+        """
+        Publish the images and labels of this generator in the shared memory
+        segment `name`, the segment is released with this generator
+        """
+        arrays = {
+            'x': self._x[self._row_ids()],
+            'y': self.dataset_y,
+        }
+        if self._source is not None:
+            # attached generators fingerprint the split from the same store
+            store, rst = self._source
+            arrays['source'] = np.frombuffer(json.dumps([store.path, rst]).encode(),
+                                             dtype=np.uint8)
+            if self._source_rows is not None:
+                arrays['source_rows'] = self._source_rows
+        self._shared = ds_store.SharedArrays.publish(name, arrays)
+        self._x = self._shared['x']
+        self._rows = None
+        self.dataset_y = self._shared['y']
+        self.labels = self.dataset_y[:]
 
-        print(self.dataset_x.shape[0] , self.dataset_y.shape[0])
-        assert (self.dataset_x.shape[0] == self.dataset_y.shape[0])
+    def _attach(self, name):
+        """
+        Use the split published by another process, without copying it
+        """
+        self._shared = ds_store.SharedArrays.attach(name)
+        for arr in self._shared.arrays.values():
+            arr.flags.writeable = False
+        self._x = self._shared['x']
+        self.keep_uint8 = self._x.dtype == np.uint8
+        self.dataset_y = self._shared['y']
+        if 'source' in self._shared.arrays:
+            path, rst = json.loads(bytes(self._shared['source']).decode())
+            self._source = (ds_store.DatasetStore(path), rst)
+            self._source_rows = self._shared.arrays.get('source_rows')
+        self._init_classes()
+
+    def _multi_chest_ids(self, store):
+        """
+        Rows of a multi chest store to keep for this split, multi-label rows are removed
+        """
+        to_train_classes = self.to_train_classes
+        single_labels = [l for l in store.classes if '|' not in l]
+        if self.data_src == self.TEST:
+            to_keep = store.ids_for([l for l in single_labels if l not in to_train_classes])
+            if len(to_keep) == 0:
+                to_keep = store.ids_for(single_labels)
+            return to_keep
+        return store.ids_for([l for l in single_labels if l in to_train_classes])
+
+    def _init_classes(self, prune_classes=None):
+        print(self.get_num_samples() , self.dataset_y.shape[0])
+        assert (self.get_num_samples() == self.dataset_y.shape[0])
 
         # Compute per class instance count.
         classes = np.unique(self.dataset_y)
@@ -88,7 +179,12 @@ class BatchGenerator:
 
         # Prune
         if prune_classes:
-            self.dataset_x, self.dataset_y = utils.prune(self.dataset_x, self.dataset_y, prune_classes)
+            self._fingerprint = None
+            to_keep = utils.prune_ids(self.dataset_y, prune_classes)
+            self._rows = self._row_ids(to_keep)
+            self._source_rows = to_keep if self._source_rows is None \
+                else self._source_rows[to_keep]
+            self.dataset_y = self.dataset_y[to_keep]
 
         # Recount after pruning
         per_class_count = list()
@@ -103,10 +199,10 @@ class BatchGenerator:
         self.labels = self.dataset_y[:]
 
         # per class ids
+        self.class_index = samplers.ClassIndex(self.labels)
         self.per_class_ids = dict()
-        ids = np.array(range(len(self.dataset_x)))
-        for c in classes:
-            self.per_class_ids[c] = ids[self.labels == c]
+        for code, c in enumerate(self.class_index.classes):
+            self.per_class_ids[c] = self.class_index.class_ids(code)
 
         self.class_weights = sk_weight.compute_class_weight('balanced',
                                                  np.unique(self.dataset_y),
@@ -118,44 +214,70 @@ class BatchGenerator:
         self.class_weights[len(self.classes)] = min_w
 
 
+    @property
+    def dataset_x(self):
+        """
+        Normalized images of every sample. In keep_uint8 mode every access
+        normalizes a float32 copy of the whole split, use get_images for the
+        rows needed
+        """
+        return self.get_images()
+
+    @dataset_x.setter
+    def dataset_x(self, x):
+        self._x = x
+        self._rows = None
+        # the images do not come from a store anymore
+        self._source = None
+        self._fingerprint = None
+
+    def _row_ids(self, ids=None):
+        """
+        Rows of self._x for the sample ids of this generator
+        """
+        if self._rows is None:
+            return slice(None) if ids is None else ids
+        return self._rows if ids is None else self._rows[ids]
+
+    def get_images(self, ids=None, out=None):
+        """
+        Images of the given rows (all rows if ids is None), normalized to [-1, 1]
+        ids: sample ids, of any shape
+        out: float32 array of shape ids.shape + image shape to write to, a
+             single channel image is broadcast to the channels of out
+        """
+        x = self._x[self._row_ids(ids)]
+        if self.keep_uint8:
+            return utils.normalize(x, out)
+        if out is None:
+            return x
+        out[...] = x
+        return out
+
     def get_samples_for_class(self, c, samples=None):
         if samples is None:
             samples = self.batch_size
         try:
             np.random.shuffle(self.per_class_ids[c])
             to_return = self.per_class_ids[c][0:samples]
-            return self.dataset_x[to_return]
+            return self.get_images(to_return)
         except:
-            random = np.arange(self.dataset_x.shape[0])
+            random = np.arange(self.get_num_samples())
             np.random.shuffle(random)
             to_return = random[:samples]
-            return self.dataset_x[to_return]
-
-
-    def get_samples_by_labels(self, labels, samples = None):
-        if samples is None:
-            samples = self.batch_size
+            return self.get_images(to_return)
 
-        count = Counter(labels)
-        classes = {k: [] for k in count.keys()}
-        for c_id in count.keys():
-            classes[c_id] = np.random.choice(self.per_class_ids[c_id], count[c_id])
 
-        new_arr = []
-        for i, label in enumerate(labels):
-            idx, classes[label] = classes[label][-1], classes[label][:-1]
-            new_arr.append(idx)
-
-        return self.dataset_x[np.array(new_arr)]
+    def get_samples_by_labels(self, labels, samples = None, out=None):
+        """
+        One image of the class of every label, drawn with replacement
+        """
+        ids = self.class_index.draw(labels)[:, 0]
+        return self.get_images(ids, out)
 
 
     def other_labels(self, labels):
-        clone = np.arange(labels.shape[0])
-        clone[:] = labels
-        for i in range(labels.shape[0]):
-            to_get = self.classes[self.classes != labels[i]]
-            clone[i] = to_get[np.random.randint(0, len(self.classes) - 1)]
-        return clone
+        return self.class_index.other_labels(labels)
 
 
     def get_label_table(self):
@@ -167,41 +289,279 @@ class BatchGenerator:
     def get_class_probability(self):
         return self.per_class_count/sum(self.per_class_count)
 
+    def fingerprint(self, chunk_size=2048):
+        """
+        sha1 of the labels and images of this generator, in sample order.
+        The images of a split read from a store are identified by the store
+        signature and the rows of the split, they are only hashed when their
+        source is unknown
+        """
+        if getattr(self, '_fingerprint', None) is None:
+            digest = hashlib.sha1(np.ascontiguousarray(self.labels).tobytes())
+            if self._source is not None:
+                store, rst = self._source
+                digest.update(store.signature(rst).encode())
+                if self._source_rows is not None:
+                    digest.update(np.ascontiguousarray(self._source_rows,
+                                                       dtype=np.int64).tobytes())
+            else:
+                size = self.get_num_samples()
+                for start in range(0, size, chunk_size):
+                    ids = np.arange(start, min(start + chunk_size, size))
+                    digest.update(np.ascontiguousarray(self.get_images(ids)).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
     ### ACCESS DATA AND SHAPES ###
     def get_num_samples(self):
-        return self.dataset_x.shape[0]
+        if self._rows is not None:
+            return len(self._rows)
+        return self._x.shape[0]
 
     def get_image_shape(self):
-        return [self.dataset_x.shape[1], self.dataset_x.shape[2], self.dataset_x.shape[3]]
+        return [self._x.shape[1], self._x.shape[2], self._x.shape[3]]
+
+    def epoch_plan(self, k_shot=0, negatives=False, target=None):
+        """
+        Stratified sample ids of one epoch, with their k-shot supports and
+        negatives if asked
+        target: class distribution, default to self.class_distribution
+        """
+        if target is None:
+            target = self.class_distribution
+        return samplers.EpochPlan(self.class_index, self.batch_size, target,
+                                  k_shot=k_shot, negatives=negatives)
+
+    def next_batch(self, plan=None):
+        """
+        plan: EpochPlan giving the batches, a plan for class_distribution is
+              drawn if class_distribution is set
+        """
+        if plan is None and self.class_distribution is not None:
+            plan = self.epoch_plan()
+        if plan is not None:
+            for ids, labels in plan:
+                yield self.batch_images(ids), labels
+            return
 
-    def next_batch(self):
-        dataset_x = self.dataset_x
         labels = self.labels
+        size = self.get_num_samples()
 
-        indices = np.arange(dataset_x.shape[0])
-        indices2 = np.arange(dataset_x.shape[0])
+        indices = np.arange(size)
+        indices2 = np.arange(size)
 
         np.random.shuffle(indices)
         # np.random.shuffle(indices2)
 
-        for start_idx in range(0, dataset_x.shape[0] - self.batch_size + 1, self.batch_size):
+        for start_idx in range(0, size - self.batch_size + 1, self.batch_size):
             access_pattern = indices[start_idx:start_idx + self.batch_size]
             # access_pattern2 = indices2[start_idx:start_idx + self.batch_size]
 
             yield (
-                dataset_x[access_pattern, :, :, :], labels[access_pattern],
+                self.get_images(access_pattern), labels[access_pattern],
                 # dataset_x[access_pattern2, :, :, :], labels[access_pattern2]
             )
 
-    def ramdom_kshot_images(self, k_shot, labels, triple=True):
-        imgs = []
-        for label in labels:
-            np.random.shuffle(self.per_class_ids[label])
-            ids = self.per_class_ids[label][:k_shot]
-            imgs.append(self.dataset_x[ids])
-        imgs = np.array(imgs)
+    def as_tf_dataset(self, k_shot=5, epochs=None, num_parallel_calls=4,
+                      prefetch=2, cache=None, negatives=True):
+        """
+        tf.data.Dataset of epoch plan batches, every element is
+        (images, labels, k-shot supports, negatives) as used by a GAN
+        training step. Only sample ids go through the python generator,
+        images are gathered by a parallel map.
+        epochs: number of epochs, None to repeat forever
+        cache: None, '' to cache the batches of the first epoch in memory or a
+               file name, later epochs then repeat these batches
+        negatives: negative sampling of the plans, see samplers.EpochPlan.
+                   Without negatives (or with k_shot=0) the negatives (or
+                   supports) of the elements are empty
+        """
+        image_shape = self.get_image_shape()
+        batch_size = self.batch_size
+        nb_negatives = batch_size if negatives else 0
+        no_support = np.zeros((batch_size, 0), dtype=np.int64)
+        no_negatives = np.zeros(0, dtype=np.int64)
+
+        def plans():
+            plan = self.epoch_plan(k_shot, negatives=negatives)
+            for i in range(len(plan)):
+                batch = plan.batch_slice(i)
+                yield (plan.ids[batch], plan.labels[batch],
+                       no_support if plan.support is None else plan.support[batch],
+                       no_negatives if plan.negatives is None else plan.negatives[batch])
+
+        def gather(ids, support, negatives):
+            return (self.get_images(ids), self.support_images(support),
+                    self.get_images(negatives))
+
+        def load(ids, labels, support, negatives):
+            images, support, negatives = tf.py_func(
+                gather, [ids, support, negatives],
+                [tf.float32, tf.float32, tf.float32], stateful=False)
+            images.set_shape([batch_size] + image_shape)
+            support.set_shape([batch_size, k_shot] + image_shape)
+            negatives.set_shape([nb_negatives] + image_shape)
+            return images, labels, support, negatives
+
+        dataset = tf.data.Dataset.from_generator(
+            plans,
+            (tf.int64, tf.as_dtype(self.labels.dtype), tf.int64, tf.int64),
+            ([batch_size], [batch_size], [batch_size, k_shot], [nb_negatives]))
+        dataset = dataset.map(load, num_parallel_calls=num_parallel_calls)
+        if cache is not None:
+            dataset = dataset.cache(cache)
+        return dataset.repeat(epochs).prefetch(prefetch)
+
+    def batch_images(self, ids, out=None):
+        """
+        Images of the samples of a plan batch, read in the plan order
+        """
+        return self.get_images(ids, out)
+
+    def ramdom_kshot_images(self, k_shot, labels, triple=False, out=None):
+        """
+        k_shot distinct images of the class of every label
+        triple: give 3 channels, the GAN encoders triple single channel
+                images in the graph so it is not needed to encode them
+        out: float32 buffer of shape (len(labels), k_shot, h, w, c) to reuse
+        return: (len(labels), k_shot, h, w, c) images, with 3 channels if triple
+        """
+        return self.support_images(self.class_index.draw_distinct(labels, k_shot),
+                                   triple, out)
+
+    def support_images(self, ids, triple=False, out=None):
+        """
+        Images of (batch, k_shot) support ids, see ramdom_kshot_images
+        """
+        if out is None:
+            shape = list(ids.shape) + self.get_image_shape()
+            if triple:
+                shape[-1] = 3
+            out = np.empty(shape, dtype=np.float32)
+        return self.get_images(ids, out)
+
+
+
+class StreamingBatchGenerator(BatchGenerator):
+    """
+    Multi chest BatchGenerator reading the images from on-disk shards.
+    Only the labels are kept in memory, images go through a bounded LRU of
+    shards and are normalized per batch.
+    The shards are built once from the dataset store of the multi chest
+    pickle. When that store does not exist yet, the conversion loads the
+    whole pickle in memory (the source images of the pickle are not
+    available), so the first run must be done on a host able to hold it,
+    the shards are then pushed to BASE_DIR and reused everywhere.
+    """
+    def __init__(
+        self,
+        data_src,
+        batch_size=5,
+        rst=64,
+        large=True,
+        shard_size=2048,
+        cache_shards=4,
+        buffer_shards=2,
+        class_distribution=None,
+    ):
+        """
+        large: use the full resolution multi chest set
+        cache_shards: max number of shards kept in memory
+        buffer_shards: number of shards shuffled together by next_batch
+        """
+        self.batch_size = batch_size
+        self.data_src = data_src
+        self.keep_uint8 = True
+        self.buffer_shards = buffer_shards
+        self.class_distribution = class_distribution
+        # sample ids are shard store rows, there is no in-memory block
+        self._x = None
+        self._rows = None
+        self._shared = None
+
+        file_name = 'imgs_labels' if large else 'imgs_labels_{}'.format(rst)
+        split = 'test' if self.data_src == self.TEST else 'train'
+        remote_dir = '{}/dataset/multi_chest/shards_{}_{}'.format(BASE_DIR, file_name, split)
+        shard_dir = staging.fetch(remote_dir)
+        if not ds_store.has_shards(shard_dir):
+            # may unpickle the full dataset, see the class docstring
+            store = ds_store.open_pickle_store(
+                '{}/dataset/multi_chest/{}.pkl'.format(BASE_DIR, file_name))
+            images = store.images(None if large else rst)
+            ds_store.write_shards(shard_dir, images, store.labels,
+                                  self._multi_chest_ids(store), shard_size)
+            staging.push(remote_dir)
+
+        self._shards = ds_store.ShardStore(shard_dir,
+                                           max(cache_shards, buffer_shards))
+        self._source = (self._shards, None)
+        self._source_rows = None
+        self.dataset_y = np.array([CATEGORIES_MAP[l] for l in self._shards.labels])
+        self._init_classes()
+
+    def get_images(self, ids=None, out=None):
+        if ids is None:
+            ids = np.arange(len(self._shards))
+        ids = np.asarray(ids)
+        imgs = self._shards.take(ids.ravel())
+        return utils.normalize(imgs.reshape(ids.shape + imgs.shape[1:]), out)
+
+    def share(self, name):
+        raise NotImplementedError(
+            'Streamed shards are read from disk, share the shard directory instead')
 
-        if triple:
-            imgs = utils.triple_channels(imgs)
-        return imgs
+    def get_num_samples(self):
+        return len(self._shards)
 
+    def get_image_shape(self):
+        return list(self._shards.image_shape)
+
+    def epoch_plan(self, k_shot=0, negatives=False, target=None):
+        """
+        Epoch plan in a shard aware order: the shards are shuffled in groups
+        of `buffer_shards` and the samples of a group are taken together,
+        in the order the plan spread them. Batches then mix the classes as
+        the shards of their group do.
+        """
+        plan = BatchGenerator.epoch_plan(self, k_shot, negatives, target)
+        group = np.empty(self._shards.nb_shards, dtype=np.int64)
+        group[np.random.permutation(self._shards.nb_shards)] = \
+            np.arange(self._shards.nb_shards) // self.buffer_shards
+        plan.reorder(np.argsort(group[plan.ids // self._shards.shard_size],
+                                kind='stable'))
+        return plan
+
+    def batch_images(self, ids, out=None):
+        """
+        Load the shards of the batch before reading it, the following batches
+        of a shard aware plan are then read from memory
+        """
+        for shard in np.unique(np.asarray(ids) // self._shards.shard_size):
+            self._shards.load(shard)
+        return self.get_images(ids, out)
+
+    def next_batch(self, plan=None):
+        """
+        Shuffle the shard order, then shuffle the rows of every
+        `buffer_shards` shards loaded together.
+        With a plan or a class distribution the batches of the plan are
+        read, see epoch_plan for their shard aware order
+        """
+        if plan is not None or self.class_distribution is not None:
+            yield from BatchGenerator.next_batch(self, plan)
+            return
+
+        shard_order = np.random.permutation(self._shards.nb_shards)
+        rest = np.array([], dtype=np.int64)
+        for start in range(0, len(shard_order), self.buffer_shards):
+            group = shard_order[start:start + self.buffer_shards]
+            for shard in group:
+                self._shards.load(shard)
+            indices = np.concatenate([rest] + [self._shards.shard_ids(s) for s in group])
+            np.random.shuffle(indices)
+
+            end = len(indices) - len(indices) % self.batch_size
+            for start_idx in range(0, end, self.batch_size):
+                access_pattern = indices[start_idx:start_idx + self.batch_size]
+                yield self.get_images(access_pattern), self.labels[access_pattern]
+            rest = indices[end:]
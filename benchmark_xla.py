@@ -0,0 +1,94 @@
+"""
+CPU benchmark of the GAN training steps with and without the XLA JIT.
+
+Every (resolution, k_shot, xla) configuration is run in a fresh process on
+the CPU, so the graphs and the peak memory of the runs are independent.
+For each one the steps per second of the train_on_batch step and of the
+fused step are measured (see BalancingGAN.benchmark_train_step), with the
+peak resident memory of the process and its growth while training.
+
+usage: python benchmark_xla.py --dataset multi_chest --resolutions 32 64 --k_shots 2 5
+"""
+import os
+import argparse
+import resource
+import multiprocessing
+from const import INVERT_CATEGORIES_MAP
+
+
+def _max_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_config(dataset, classes, rst, k_shot, xla, batch_size, steps, warmup):
+    """
+    Build the models and time the training steps of one configuration
+    classes: classes of the training split
+    return: dict of the measures
+    """
+    # hide the GPUs before tensorflow is imported
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    import numpy as np
+    from batch_gen import BatchGenerator
+    from new_gan import BalancingGAN
+
+    class Generator(BatchGenerator):
+        to_train_classes = classes
+
+    bg = Generator(Generator.TRAIN, batch_size, dataset, rst)
+    channels = bg.get_images(np.arange(1)).shape[-1]
+    gan = BalancingGAN(
+        bg.get_label_table(), loss_type='hinge',
+        image_shape=[rst, rst, channels], dataset=dataset,
+        resnet=True, k_shot=k_shot, xla=xla,
+    )
+    built_mb = _max_rss_mb()
+    res = gan.benchmark_train_step(bg, steps=steps, warmup=warmup)
+    res['peak_mb'] = _max_rss_mb()
+    res['train_mb'] = res['peak_mb'] - built_mb
+    return res
+
+
+def run_isolated(*args):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_config, args)
+
+
+def draw_table(rows):
+    columns = ['train_on_batch', 'fused', 'peak_mb', 'train_mb']
+    table = '| rst | k_shot | xla | ' + ' | '.join(columns) + ' |\n'
+    table += '|--' * (len(columns) + 3) + '|\n'
+    for (rst, k_shot, xla), res in rows:
+        table += '| {} | {} | {} | '.format(rst, k_shot, xla)
+        table += ' | '.join('{:.2f}'.format(res[c]) for c in columns) + ' |\n'
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--dataset', default='multi_chest')
+    parser.add_argument('--classes', nargs='+', default=INVERT_CATEGORIES_MAP[:3],
+                        help='training classes, label names for multi_chest')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--k_shots', type=int, nargs='+', default=[2, 5])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    args = parser.parse_args()
+
+    rows = []
+    for rst in args.resolutions:
+        for k_shot in args.k_shots:
+            for xla in [False, True]:
+                print('rst {}, k_shot {}, xla {}'.format(rst, k_shot, xla))
+                res = run_isolated(args.dataset, args.classes, rst, k_shot, xla,
+                                   args.batch_size, args.steps, args.warmup)
+                rows.append(((rst, k_shot, xla), res))
+    print('steps/s and memory (MB):')
+    print(draw_table(rows))
+
+
+if __name__ == '__main__':
+    main()
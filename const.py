@@ -1,3 +1,5 @@
+import os
+
 # Chest x-ray 14
 CATEGORIES_MAP = {
     'No Finding' : 0,
@@ -22,4 +24,7 @@ INVERT_CATEGORIES_MAP = ['No Finding', 'Infiltration', 'Atelectasis',
     'Emphysema', 'Fibrosis', 'Edema', 'Pneumonia','Hernia']
 
 # Project dir
-BASE_DIR = '/content/drive/My Drive/bagan'
\ No newline at end of file
+BASE_DIR = '/content/drive/My Drive/bagan'
+# Local copy of the artifacts under BASE_DIR (see staging.py),
+# set it to BASE_DIR to read and write the project dir directly
+LOCAL_CACHE_DIR = os.environ.get('BAGAN_LOCAL_CACHE', '/tmp/bagan')
@@ -1,5 +1,7 @@
 import numpy as np
 import pickle
+import ds_store
+import staging
 from const import BASE_DIR, INVERT_CATEGORIES_MAP, CATEGORIES_MAP
 from utils import *
 from collections import Counter
@@ -7,92 +9,101 @@ from sklearn.model_selection import train_test_split
 
 
 def load_gen(ds_name, version=1):
-    x,y = pickle_load(
+    x,y = pickle_load(staging.fetch(
         BASE_DIR + '/dataset/{}/imgs_train_gen_v{}.pkl'.format(ds_name, version)
-    )
-    x = (x - 127.5) / 127.5
-    return x,y
+    ))
+    return normalize(x), y
 
 
 def _load_multi_chest(rst, large, classes):
+    """
+    return: (images, train ids, train labels), (images, unseen ids, unseen labels)
+    """
     file_name = 'imgs_labels'
     if not large:
         file_name += '_' + str(rst)
     file_name += '.pkl'
-    x, y = pickle_load(BASE_DIR + '/dataset/multi_chest/'  + file_name)
-    to_keep = [i for i, l in enumerate(y) if '|' not in l]
-    to_keep = np.array(to_keep)
-    x = x[to_keep]
-    y = y[to_keep]
+    store, x = ds_store.load_shared(BASE_DIR + '/dataset/multi_chest/'  + file_name)
+    single_labels = [l for l in store.classes if '|' not in l]
     to_train_classes = INVERT_CATEGORIES_MAP[:classes]
-    to_keep = np.array([i for i, l in enumerate(y) if l in to_train_classes])
-    x_train, y_train = x[to_keep], y[to_keep]
-    y_train = np.array([CATEGORIES_MAP[l] for l in y_train])
+    train_ids = store.ids_for(to_train_classes)
+    y_train = np.array([CATEGORIES_MAP[l] for l in store.labels[train_ids]])
 
-    to_keep = np.array([i for i, l in enumerate(y) if l not in to_train_classes])
+    unseen_ids = store.ids_for([l for l in single_labels if l not in to_train_classes])
 
     # unseen classes data
-    if len(to_keep) > 0:
-        x_unseen, y_unseen = x[to_keep], y[to_keep]
-        x_unseen = (x_unseen - 127.5) / 127.5
-        y_unseen = np.array([CATEGORIES_MAP[l] for l in y_unseen])
+    if len(unseen_ids) > 0:
+        y_unseen = np.array([CATEGORIES_MAP[l] for l in store.labels[unseen_ids]])
+        unseen = (x, unseen_ids, y_unseen)
     else:
-        x_unseen, y_unseen = None, None
+        unseen = None
 
-    return x_train, y_train, x_unseen, y_unseen
+    return (x, train_ids, y_train), unseen
 
 def _load_chest(rst):
-    x_train, y_train  = load_ds(rst, 'train')
-    x_test, y_test  = load_ds(rst, 'test')
-    x_test = (x_test - 127.5) / 127.5
-    x_test = triple_channels(x_test)
-    x_train, y_train = prune(x_train, y_train, [0, 2400])
-    return x_train, y_train, x_test, y_test
+    x_train, y_train  = load_train_data(rst)
+    x_test, y_test  = load_test_data(rst)
+    train_ids = prune_ids(y_train, [0, 2400])
+    return (x_train, train_ids, y_train[train_ids]), (x_test, np.arange(len(y_test)), y_test)
 
 def _load_flower(classes):
-    x, y = pickle_load(BASE_DIR + '/dataset/flowers/imgs_labels.pkl')
-    y = y - 1
-    to_train_classes = list(range(0, classes))
-    to_test_classes = list(range(80, 85))
-    to_keep = np.array([i for i, l in enumerate(y) if l in to_test_classes])
-    x_unseen, y_unseen = x[to_keep], y[to_keep]
-    to_keep = np.array([i for i, l in enumerate(y) if l in to_train_classes])
-    x_train, y_train = x[to_keep], y[to_keep]
-    x_unseen = (x_unseen - 127.5) / 127.5
-
-    return x_train, y_train, x_unseen, y_unseen
+    store, x = ds_store.load_shared(BASE_DIR + '/dataset/flowers/imgs_labels.pkl')
+    # labels in the store start from 1
+    to_train_classes = list(range(1, classes + 1))
+    to_test_classes = list(range(81, 86))
+    unseen_ids = store.ids_for(to_test_classes)
+    train_ids = store.ids_for(to_train_classes)
+    y_unseen = store.labels[unseen_ids] - 1
+    y_train = store.labels[train_ids] - 1
+
+    return (x, train_ids, y_train), (x, unseen_ids, y_unseen)
 
 def load_dataset(dataset='multi_chest',
                 resolution=64,
                 large=False,
                 classes=5,
-                test_val_split=[0.3, 0.1]):
+                test_val_split=[0.3, 0.1],
+                keep_uint8=False):
     """
+    Splits are computed on sample ids, images of each split are gathered
+    (and normalized) once at the end.
+    keep_uint8: return raw uint8 images, use utils.normalize on each batch
     return: train_pair, val_pair, test_pair, unseen_pair
     """
+    test = None
     if dataset == 'multi_chest':
-        x_train, y_train, x_unseen, y_unseen = _load_multi_chest(resolution, large, classes)
+        train, unseen = _load_multi_chest(resolution, large, classes)
 
     elif dataset == 'chest':
-        x_train, y_train, x_test, y_test = _load_chest(resolution)
-        x_unseen, y_unseen = None, None
+        train, test = _load_chest(resolution)
+        unseen = None
     elif dataset == 'flowers':
-        x_train, y_train, x_unseen, y_unseen = _load_flower(classes)
+        train, unseen = _load_flower(classes)
 
-    # norm
-    x_train = (x_train - 127.5) / 127.5
-    random = np.arange(x_train.shape[0])
-    np.random.shuffle(random)
-    x_train, y_train = x_train[random], y_train[random]
-    # x_train = triple_channels(x_train)
+    x, ids, y = train
+    # position of the samples in `ids`
+    random = np.random.permutation(len(ids))
 
-    x_train, x_val, y_train, y_val = train_test_split(x_train,
-                                                    y_train,
-                                                    test_size=test_val_split[1])
+    train_pos, val_pos = train_test_split(random, test_size=test_val_split[1])
     if dataset != 'chest':
-        x_train, x_test, y_train, y_test = train_test_split(x_train,
-                                                y_train,
-                                                test_size=test_val_split[0])
+        train_pos, test_pos = train_test_split(train_pos, test_size=test_val_split[0])
+        test = (x, ids[test_pos], y[test_pos])
+
+    def take(pair):
+        if pair is None:
+            return None, None
+        x, ids, y = pair
+        if keep_uint8:
+            return x[ids], y
+        return take_normalized(x, ids), y
+
+    x_train, y_train = take((x, ids[train_pos], y[train_pos]))
+    x_val, y_val = take((x, ids[val_pos], y[val_pos]))
+    x_test, y_test = take(test)
+    x_unseen, y_unseen = take(unseen)
+    if dataset == 'chest':
+        x_test = triple_channels(x_test)
+    # x_train = triple_channels(x_train)
     # if x_unseen is not None:
         # x_unseen = triple_channels(x_unseen)
 
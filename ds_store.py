@@ -0,0 +1,500 @@
+"""
+Memory-mapped dataset store.
+
+A store is a directory with:
+    - images_{rst}.npy: raw uint8 image block (N, rst, rst, C), opened with np.memmap
+    - images_{rst}.npy.sha1 (optional): sha1 of the block, see block_sha1
+    - labels.npy: integer label code of every row
+    - classes.npy: label value of every code
+    - class_index.npz: rows grouped by code (`order`) and start of each group (`offsets`)
+    - manifest.json (optional): source file of every row, used for incremental rebuilds
+
+Opening a store only reads the labels and the class index, image rows are
+read from disk when they are taken.
+"""
+import os
+import re
+import json
+import hashlib
+import pickle
+import shutil
+import weakref
+import numpy as np
+from collections import OrderedDict
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python < 3.8, datasets can not be shared between processes
+    shared_memory = None
+import logger
+import staging
+
+
+def store_path(pkl_path):
+    """
+    Store directory used in place of a `.pkl` dataset file
+    """
+    return os.path.splitext(pkl_path)[0]
+
+
+def _images_name(rst):
+    return 'images_{}.npy'.format(rst)
+
+
+def write_class_index(path, codes, nb_classes):
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=nb_classes)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    np.savez(os.path.join(path, 'class_index.npz'), order=order, offsets=offsets)
+
+
+def write_images(path, imgs):
+    """
+    Write an uint8 image block, the resolution is taken from the image shape
+    """
+    fname = os.path.join(path, _images_name(imgs.shape[1]))
+    block = np.lib.format.open_memmap(fname + '.tmp', mode='w+',
+                                      dtype=np.uint8, shape=imgs.shape)
+    block[:] = imgs
+    block.flush()
+    del block
+    _drop_sha1(fname)
+    os.replace(fname + '.tmp', fname)
+
+
+def append_images(path, rst, to_keep, new_imgs, chunk_size=1024, dst=None):
+    """
+    Rewrite an image block with the rows `to_keep` followed by `new_imgs`
+    dst: store directory to write the block to, default to path
+    """
+    old = np.load(os.path.join(path, _images_name(rst)), mmap_mode='r')
+    fname = os.path.join(path if dst is None else dst, _images_name(rst))
+    shape = (len(to_keep) + len(new_imgs),) + old.shape[1:]
+    block = np.lib.format.open_memmap(fname + '.tmp', mode='w+',
+                                      dtype=np.uint8, shape=shape)
+    for start in range(0, len(to_keep), chunk_size):
+        rows = to_keep[start:start + chunk_size]
+        block[start:start + len(rows)] = old[rows]
+    block[len(to_keep):] = new_imgs
+    block.flush()
+    del block, old
+    _drop_sha1(fname)
+    os.replace(fname + '.tmp', fname)
+
+
+def _drop_sha1(fname):
+    if os.path.exists(fname + '.sha1'):
+        os.remove(fname + '.sha1')
+
+
+def block_sha1(path, rst, chunk_size=1 << 24):
+    """
+    sha1 of an image block file. It is computed once and kept next to the
+    block with the size and mtime of the block it was computed for
+    """
+    fname = os.path.join(path, _images_name(rst))
+    stat = os.stat(fname)
+    key = '{} {}'.format(stat.st_size, stat.st_mtime_ns)
+    if os.path.exists(fname + '.sha1'):
+        with open(fname + '.sha1', 'r') as f:
+            digest, _, cached_key = f.read().partition(' ')
+        if cached_key == key:
+            return digest
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+    with open(fname + '.sha1.tmp', 'w') as f:
+        f.write('{} {}'.format(digest, key))
+    os.replace(fname + '.sha1.tmp', fname + '.sha1')
+    return digest
+
+
+def write_labels(path, labels):
+    os.makedirs(path, exist_ok=True)
+    classes, codes = np.unique(np.asarray(labels), return_inverse=True)
+    np.save(os.path.join(path, 'classes.npy'), classes)
+    np.save(os.path.join(path, 'labels.npy'), codes)
+    write_class_index(path, codes, len(classes))
+
+
+def write_store(path, imgs, labels):
+    """
+    Save images and labels as a store
+    imgs: uint8 array (N, rst, rst, C), can be a memmap
+    labels: array of label values, any type np.unique can sort
+    """
+    write_labels(path, labels)
+    write_images(path, imgs)
+    logger.info('Dataset store written to {}'.format(path))
+
+
+def read_manifest(path):
+    """
+    return: list of source entries in row order, None if the store has no manifest
+    """
+    fname = os.path.join(path, 'manifest.json')
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(path, entries):
+    """
+    entries: one dict per row, with keys path, size, mtime, sha1 and label
+    """
+    fname = os.path.join(path, 'manifest.json')
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(entries, f)
+    os.replace(fname + '.tmp', fname)
+
+
+def update_store(path, to_keep, new_imgs, new_labels, entries):
+    """
+    Rewrite a store with its rows `to_keep` followed by new rows. The new
+    store is written to a temporary directory swapped with the store once
+    complete, so images, labels and manifest are always in sync.
+    new_imgs: {rst: uint8 images of the new rows} for every block of the store
+    new_labels: label values of the new rows
+    entries: manifest of the rows of the new store
+    """
+    store = DatasetStore(path)
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for rst, imgs in new_imgs.items():
+        append_images(path, rst, to_keep, imgs, dst=tmp)
+    write_labels(tmp, np.concatenate([store.labels[to_keep], new_labels]))
+    write_manifest(tmp, entries)
+
+    old = path + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old)
+
+
+def recover_store(path):
+    """
+    Put back a store left aside by an update_store interrupted between its
+    two renames
+    """
+    if not os.path.exists(path) and os.path.exists(path + '.old'):
+        os.rename(path + '.old', path)
+
+
+def has_store(path, rst=None):
+    if not os.path.exists(os.path.join(path, 'labels.npy')):
+        return False
+    if rst is None:
+        return len(DatasetStore.list_resolutions(path)) > 0
+    return os.path.exists(os.path.join(path, _images_name(rst)))
+
+
+class DatasetStore:
+    def __init__(self, path):
+        self.path = path
+        self.classes = np.load(os.path.join(path, 'classes.npy'))
+        self.codes = np.load(os.path.join(path, 'labels.npy'))
+        index = np.load(os.path.join(path, 'class_index.npz'))
+        self.order = index['order']
+        self.offsets = index['offsets']
+
+    @staticmethod
+    def list_resolutions(path):
+        rsts = []
+        for f in os.listdir(path):
+            match = re.match(r'images_(\d+)\.npy$', f)
+            if match:
+                rsts.append(int(match.group(1)))
+        return sorted(rsts)
+
+    def resolutions(self):
+        return self.list_resolutions(self.path)
+
+    def resolution(self, rst=None):
+        """
+        rst, or the resolution of the single block of the store if None
+        """
+        if rst is None:
+            rsts = self.resolutions()
+            if len(rsts) != 1:
+                raise ValueError('Store {} has resolutions {}, please give one'.format(
+                    self.path, rsts))
+            rst = rsts[0]
+        return rst
+
+    def signature(self, rst=None):
+        """
+        Identifier of the content of an image block, see block_sha1
+        """
+        rst = self.resolution(rst)
+        return '{}:{}'.format(_images_name(rst), block_sha1(self.path, rst))
+
+    def images(self, rst=None):
+        """
+        Memory-mapped image block, read only
+        rst: resolution of the block, None if the store has a single block
+        """
+        return np.load(os.path.join(self.path, _images_name(self.resolution(rst))),
+                       mmap_mode='r')
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def labels(self):
+        return self.classes[self.codes]
+
+    def class_ids(self, code):
+        return self.order[self.offsets[code]:self.offsets[code + 1]]
+
+    def ids_for(self, to_keep):
+        """
+        Rows whose label is in `to_keep`, in ascending order
+        """
+        codes = np.where(np.isin(self.classes, list(to_keep)))[0]
+        if len(codes) == 0:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate([self.class_ids(c) for c in codes]))
+
+    def take(self, ids, rst=None):
+        """
+        Read the given rows into memory
+        return: (uint8 images, label values)
+        """
+        return self.images(rst)[ids], self.classes[self.codes[ids]]
+
+
+def open_pickle_store(pkl_path):
+    """
+    Open the store of a `(x, y)` pickle, converting the pickle on first use.
+    The conversion unpickles the whole dataset, the store is pushed to
+    BASE_DIR so it only has to run once, on a host with enough memory
+    """
+    path = staging.fetch(store_path(pkl_path))
+    if not has_store(path):
+        logger.info('Convert {} to a dataset store'.format(pkl_path))
+        with open(staging.fetch(pkl_path), 'rb') as f:
+            x, y = pickle.load(f)
+        write_store(path, x, y)
+        del x, y
+        staging.push(store_path(pkl_path))
+    return DatasetStore(path)
+
+
+_registry = {}
+
+
+def shared(key, loader):
+    """
+    Process-wide registry of loaded datasets, `loader` is only called the
+    first time a key is requested
+    """
+    if key not in _registry:
+        _registry[key] = loader()
+    return _registry[key]
+
+
+def clear_shared():
+    _registry.clear()
+
+
+def load_shared(pkl_path, rst=None):
+    """
+    Store of a pickle with its image block, opened once per process. The
+    block is the read-only memmap of the store: rows are read from disk, or
+    from the page cache shared by the processes of the host, when they are
+    taken, so the memory used follows the rows in use.
+    rst: resolution of the block, None if the store has a single block
+    return: (DatasetStore, uint8 images)
+    """
+    store = shared(store_path(pkl_path), lambda: open_pickle_store(pkl_path))
+    # the same block whether rst is given or not
+    rst = store.resolution(rst)
+    return store, shared((store_path(pkl_path), rst), lambda: store.images(rst))
+
+
+SHM_HEADER_SIZE = 4096
+HAS_SHARED_MEMORY = shared_memory is not None
+
+
+def _release_shared_memory(shm, owner):
+    try:
+        shm.close()
+    except BufferError:
+        # arrays on the segment are still referenced, the mapping is
+        # released with the process
+        pass
+    if owner:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedArrays:
+    """
+    Numpy arrays published in a named shared-memory segment.
+    The segment starts with a json header giving dtype, shape and offset of
+    every array, other processes attach to it without copying.
+    The owner unlinks the segment when the object is closed, garbage
+    collected or when the process exits.
+    """
+    def __init__(self, shm, layout, owner):
+        self.name = shm.name
+        self.owner = owner
+        self._shm = shm
+        self.arrays = {
+            key: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            for key, (dtype, shape, offset) in layout.items()
+        }
+        self._finalizer = weakref.finalize(self, _release_shared_memory, shm, owner)
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    @classmethod
+    def publish(cls, name, arrays):
+        layout = {}
+        size = SHM_HEADER_SIZE
+        for key, arr in arrays.items():
+            arr = np.asarray(arr)
+            layout[key] = (arr.dtype.str, arr.shape, size)
+            # keep every array 64 bytes aligned
+            size += -(-arr.nbytes // 64) * 64
+        header = json.dumps(layout).encode()
+        if len(header) > SHM_HEADER_SIZE:
+            raise ValueError('Too many arrays for a shared segment')
+
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[:len(header)] = header
+        shm.buf[len(header):SHM_HEADER_SIZE] = bytes(SHM_HEADER_SIZE - len(header))
+        res = cls(shm, layout, owner=True)
+        for key, arr in arrays.items():
+            res.arrays[key][...] = arr
+        logger.info('Published {} ({} MB) in shared memory'.format(name, size >> 20))
+        return res
+
+    @classmethod
+    def attach(cls, name):
+        shm = shared_memory.SharedMemory(name=name)
+        # the segment belongs to its owner, do not let the resource tracker
+        # of this process unlink it at exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        header = bytes(shm.buf[:SHM_HEADER_SIZE]).rstrip(b'\0')
+        layout = {
+            key: (dtype, tuple(shape), offset)
+            for key, (dtype, shape, offset) in json.loads(header.decode()).items()
+        }
+        return cls(shm, layout, owner=False)
+
+    @staticmethod
+    def exists(name):
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return False
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+        return True
+
+    def close(self):
+        self.arrays = {}
+        self._finalizer()
+
+
+def write_shards(path, imgs, labels, ids=None, shard_size=2048):
+    """
+    Split the rows `ids` of an image block into uint8 shard files
+    imgs: image block, usually DatasetStore.images() so only one shard
+          is in memory at a time
+    labels: label value of every row of imgs
+    """
+    if ids is None:
+        ids = np.arange(len(labels))
+    os.makedirs(path, exist_ok=True)
+    nb_shards = 0
+    for start in range(0, len(ids), shard_size):
+        shard = np.asarray(imgs[ids[start:start + shard_size]], dtype=np.uint8)
+        np.save(os.path.join(path, 'shard_{:05d}.npy'.format(nb_shards)), shard)
+        nb_shards += 1
+    np.savez(os.path.join(path, 'shards.npz'),
+             labels=np.asarray(labels)[ids],
+             shard_size=shard_size,
+             nb_shards=nb_shards)
+    logger.info('{} shards written to {}'.format(nb_shards, path))
+
+
+def has_shards(path):
+    return os.path.exists(os.path.join(path, 'shards.npz'))
+
+
+class ShardStore:
+    """
+    Read-only view over shard files with a bounded LRU of loaded shards.
+    Rows of shards which are not cached are read through a memmap.
+    """
+    def __init__(self, path, cache_size=4):
+        self.path = path
+        self.cache_size = cache_size
+        meta = np.load(os.path.join(path, 'shards.npz'))
+        self.labels = meta['labels']
+        self.shard_size = int(meta['shard_size'])
+        self.nb_shards = int(meta['nb_shards'])
+        self._cache = OrderedDict()
+        self.image_shape = self._open(0).shape[1:]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def signature(self, rst=None):
+        """
+        Identifier of the shards, from their metadata and file sizes. Shards
+        are written once and never modified in place
+        rst: unused, the shards have a single resolution
+        """
+        digest = hashlib.sha1()
+        with open(os.path.join(self.path, 'shards.npz'), 'rb') as f:
+            digest.update(f.read())
+        for shard in range(self.nb_shards):
+            digest.update(str(os.path.getsize(self._fname(shard))).encode())
+        return 'shards:' + digest.hexdigest()
+
+    def _fname(self, shard):
+        return os.path.join(self.path, 'shard_{:05d}.npy'.format(shard))
+
+    def _open(self, shard):
+        return np.load(self._fname(shard), mmap_mode='r')
+
+    def shard_ids(self, shard):
+        start = shard * self.shard_size
+        return np.arange(start, min(start + self.shard_size, len(self)))
+
+    def load(self, shard):
+        """
+        Read a whole shard into memory, evicting the least recently used one
+        """
+        if shard in self._cache:
+            self._cache.move_to_end(shard)
+            return self._cache[shard]
+        self._cache[shard] = np.load(self._fname(shard))
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return self._cache[shard]
+
+    def take(self, ids):
+        ids = np.asarray(ids)
+        out = np.empty((len(ids),) + self.image_shape, dtype=np.uint8)
+        shard_of = ids // self.shard_size
+        for shard in np.unique(shard_of):
+            mask = shard_of == shard
+            if shard in self._cache:
+                self._cache.move_to_end(shard)
+                src = self._cache[shard]
+            else:
+                src = self._open(shard)
+            out[mask] = src[ids[mask] - shard * self.shard_size]
+        return out
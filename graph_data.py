@@ -0,0 +1,71 @@
+"""
+Dataset of a BatchGenerator held in the TF graph.
+
+The normalized images, the labels and the class index are stored in
+non-trainable variables. A training step only feeds the sample ids of its
+batch, k-shot supports and negatives are drawn and gathered in the graph.
+"""
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+
+def _local_variable(value, dtype, name):
+    """
+    Variable initialized from a placeholder, so big arrays are not stored in
+    the graph definition. Local variables are left alone by the keras
+    variable initialization.
+    """
+    init = tf.placeholder(dtype, shape=value.shape)
+    var = tf.Variable(init, trainable=False, name=name,
+                      collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    K.get_session().run(var.initializer, {init: value})
+    return var
+
+
+class GraphDataset:
+    def __init__(self, bg, k_shot):
+        """
+        bg: BatchGenerator, its images must fit in the device memory
+        k_shot: support images drawn per sample
+        """
+        self.batch_size = bg.batch_size
+        self.k_shot = k_shot
+        index = bg.class_index
+        nb_classes = len(index.classes)
+        if nb_classes < 2:
+            raise ValueError('Negatives need samples of at least two classes, '
+                             'got {} class(es)'.format(nb_classes))
+
+        with tf.name_scope('graph_dataset'):
+            self.images = _local_variable(bg.get_images(), tf.float32, 'images')
+            self.codes = _local_variable(index.codes.astype(np.int64), tf.int64, 'codes')
+            self.classes = tf.constant(index.classes)
+            order = tf.constant(index.order.astype(np.int64))
+            offsets = tf.constant(index.offsets.astype(np.int64))
+            counts = tf.constant(index.counts.astype(np.float32))
+
+            # sample ids of the batch, the only value fed per step
+            self.ids = tf.placeholder(tf.int64, shape=(None,), name='ids')
+            batch_codes = tf.gather(self.codes, self.ids)
+            size = tf.shape(self.ids)[0]
+
+            def draw(codes, shape):
+                # ids of the classes `codes`, drawn with replacement
+                pos = tf.random_uniform(shape) * tf.reshape(
+                    tf.gather(counts, codes), [-1] + [1] * (len(shape) - 1))
+                start = tf.reshape(tf.gather(offsets, codes), [-1] + [1] * (len(shape) - 1))
+                return tf.gather(order, start + tf.cast(pos, tf.int64))
+
+            self.support_ids = draw(batch_codes, [size, k_shot])
+            other = tf.random_uniform([size], 0, nb_classes - 1, dtype=tf.int64)
+            other += tf.cast(other >= batch_codes, tf.int64)
+            self.negative_ids = draw(other, [size])
+
+            self.batch_images = tf.gather(self.images, self.ids)
+            self.labels = tf.gather(self.classes, batch_codes)
+            self.support = tf.gather(self.images, self.support_ids)
+            self.negatives = tf.gather(self.images, self.negative_ids)
+
+    def feed(self, ids):
+        return {self.ids: ids}
@@ -40,6 +40,8 @@ import seaborn as sns
 
 import os
 import sys
+import contextlib
+import weakref
 import re
 import numpy as np
 import datetime
@@ -47,6 +49,10 @@ import pickle
 import cv2
 import utils
 import logger
+import staging
+import prefetch
+import graph_data
+import samplers
 from const import BASE_DIR
 
 K.common.set_image_dim_ordering('tf')
@@ -362,16 +368,32 @@ class BalancingGAN:
             name='attribute_encoder',
         )
 
-    def get_attribute_tensor(self, images, average=True):
-        attr_features = [
-            self.latent_encoder(
-                Lambda(lambda x: x[:, i,])(images)
-            ) for i in range(self.k_shot)
-        ]
-        if len(attr_features) == 1:
-            return attr_features[0]
+    def _per_shot(self, model, images, channels=3):
+        """
+        Run model once over the batch * k_shot images of a
+        (batch, k_shot, h, w, c) tensor, keeping the first `channels` channels
+        return: (batch, k_shot, features) tensor
+        """
+        image_shape = (self.resolution, self.resolution, channels)
+        shots = Lambda(
+            lambda x: K.reshape(x[..., :channels], (-1,) + image_shape)
+        )(images)
+        features = model(shots)
+        size = K.int_shape(features)[-1]
+        return Lambda(lambda x: K.reshape(x, (-1, self.k_shot, size)))(features)
 
-        return Average()(attr_features) if average else attr_features
+    def get_attribute_tensor(self, images, average=True):
+        """
+        Attribute codes of (batch, k_shot, h, w, c) images, images with the
+        dataset channels are tripled in the graph
+        average: mean over the shots, else a (batch, k_shot, latent_size) tensor
+        """
+        channels = K.int_shape(images)[-1]
+        encoder = self.latent_encoder if channels == 3 else self.gray_latent_encoder
+        attr_features = self._per_shot(encoder, images, channels)
+        if not average:
+            return attr_features
+        return Lambda(lambda x: K.mean(x, axis=1))(attr_features)
 
 
     def attribute_net(self, images, channels):
@@ -390,15 +412,27 @@ class BalancingGAN:
         fname = '{}/{}/latent_encoder_{}'.format(BASE_DIR,
                                                 self.dataset,
                                                 self.resolution)
-        json_file = open(fname + '.json', 'r')
+        json_file = open(staging.fetch(fname + '.json'), 'r')
         model = json_file.read()
         json_file.close()
         self.latent_encoder = model_from_json(model)
         modified = os.path.getmtime(fname + '.json')
         print('Latent model modified at: ',
             datetime.datetime.fromtimestamp(modified).strftime('%Y-%m-%d %H:%M:%S'))
-        self.latent_encoder.load_weights(fname + '.h5')
+        self.latent_encoder.load_weights(staging.fetch(fname + '.h5'))
         self.latent_encoder.trainable = False
+        # attribute codes cached on disk are keyed by the encoder weights,
+        # in memory by the generator
+        self.latent_encoder_key = utils.file_sha1(staging.fetch(fname + '.h5'))
+        self._attribute_codes = weakref.WeakKeyDictionary()
+
+        # input adapter tripling the channels of dataset images in the graph
+        image = Input(shape=(self.resolution, self.resolution, self.channels))
+        self.gray_latent_encoder = Model(
+            inputs=image,
+            outputs=self.latent_encoder(self._triple_tensor(image)),
+            name='gray_latent_encoder',
+        )
 
 
     def generate_images_for_class(self, bg, classid, samples=10, repeat=False):
@@ -436,7 +470,7 @@ class BalancingGAN:
             size += len(bg_test.classes)
 
         sp_vectors = self.means[:size].reshape(-1, 1, self.latent_size)
-        vectors = self.latent_code(utils.triple_channels(images))
+        vectors = self.latent_code(images)
         metric_func = l2_distance if metric == 'l2' else cosine_sim
         similiarity = np.array([metric_func(vector, sp_vector) \
                             for vector in vectors \
@@ -517,25 +551,30 @@ class BalancingGAN:
             self.covariances = list(self.covariances)
             self.means = list(self.means)
 
+        codes = self.attribute_codes(bg)
         for c in np.unique(bg.dataset_y):
-            imgs = bg.dataset_x[bg.per_class_ids[c]]
-            imgs = utils.triple_channels(imgs)
-            latent = self.latent_code(imgs)
+            latent = codes[bg.per_class_ids[c]]
             
             self.covariances.append(np.cov(np.transpose(latent)))
             self.means.append(np.mean(latent, axis=0))
 
         self.covariances = np.array(self.covariances)
         self.means = np.array(self.means)
+        self.latent_sampler = samplers.LatentSampler(self.means, self.covariances)
 
 
     def latent_code(self, images, prediction=True):
         """
         Get prediction from latent encoder (Attribute code)
+        images: 3 channel images, or images with the dataset channels which
+                are tripled in the graph
         """
+        encoder = self.latent_encoder
+        if images.shape[-1] != 3:
+            encoder = self.gray_latent_encoder
         if prediction:
-            return self.latent_encoder.predict(images)
-        return self.latent_encoder(images)
+            return encoder.predict(images)
+        return encoder(images)
 
     def latent_codes(self, k_shot_images, prediction=True):
         """
@@ -543,9 +582,9 @@ class BalancingGAN:
         shape = (batch_size, K_shot, H, W, C)
         return: array with shape (batch_size, latent_code_size)
         """
-        return np.array([
-            np.mean(self.latent_code(i), axis=0) for i in k_shot_images
-            ])
+        shots = k_shot_images.reshape((-1,) + k_shot_images.shape[2:])
+        codes = self.latent_code(shots)
+        return codes.reshape(k_shot_images.shape[:2] + (-1,)).mean(axis=1)
 
 
     def __init__(self, classes, loss_type = 'binary',
@@ -556,7 +595,37 @@ class BalancingGAN:
                 dataset = 'chest', attention=True,
                 k_shot=5, sampling='normal',
                 advance_losses={'triplet': 0.1},
+                prefetch=0,
+                input_pipeline='numpy',
+                hard_negatives=0,
+                fused_step=False,
+                simultaneous_update=False,
+                steps_per_call=1,
+                xla=False,
                 ):
+        """
+        prefetch: number of training steps whose inputs are prepared ahead
+                  by a background thread, 0 to prepare them between steps
+        input_pipeline: 'numpy' to build the step inputs in python, 'tf.data'
+                        to read them from BatchGenerator.as_tf_dataset,
+                        'graph' to keep the dataset in the graph and gather
+                        the step inputs there (see graph_data)
+        hard_negatives: draw the negatives of the generator triplet loss
+                        among the hard_negatives samples of other classes
+                        nearest to the center of the anchor class in the
+                        latent encoder space, 0 for uniform negatives. The
+                        encoder is frozen so the index is built once. Not
+                        used by the 'graph' input pipeline
+        fused_step: train D then G in a single session call per step, with
+                    one optimizer for D (see _fused_graph)
+        simultaneous_update: in fused steps, compute the G loss against D at
+                             the start of the step and apply both updates
+                             together, instead of after the D update
+        steps_per_call: run this many fused steps per session call, in an
+                        in-graph loop over a block of prefetched inputs
+        xla: compile the generator and discriminator forwards and the
+             training steps with the XLA JIT (see _jit_scope)
+        """
         self.classes = classes
         self.dataset = dataset
         self.nclasses = len(classes)
@@ -572,6 +641,28 @@ class BalancingGAN:
         # code: sampling from latent code distribution (computed by classifier)
         self.sampling = sampling
         self.advance_losses = advance_losses
+        self.prefetch = prefetch
+        self.input_pipeline = input_pipeline
+        # next element op of the tf.data pipeline of every generator, the
+        # per generator caches have weak keys so they die with the generator
+        self._tf_inputs = weakref.WeakKeyDictionary()
+        # in-graph training functions of every generator
+        self._graph_steps = weakref.WeakKeyDictionary()
+        self.hard_negatives = hard_negatives
+        # hard negative index of every generator
+        self._hard_negative_index = weakref.WeakKeyDictionary()
+        self.fused_step = fused_step
+        self.simultaneous_update = simultaneous_update
+        self.steps_per_call = steps_per_call
+        if (fused_step or steps_per_call > 1) and not simultaneous_update:
+            # control dependencies only order the reads of resource
+            # variables, the G loss of a fused step must read the updated D
+            tf.enable_resource_variables()
+        # fused training functions of every generator, and their optimizers
+        self._fused_steps = weakref.WeakKeyDictionary()
+        self._multi_steps = weakref.WeakKeyDictionary()
+        self._optimizers = None
+        self.xla = xla
 
         self.norm = norm
         self.loss_type = loss_type
@@ -606,10 +697,12 @@ class BalancingGAN:
         self.build_perceptual_model()
         self.build_latent_encoder()
         self.build_attribute_encoder()
-        self.build_discriminator()
+        with self._jit_scope():
+            self.build_discriminator()
         self.build_features_from_d_model()
         if self.resnet:
-            self.build_resnet_generator()
+            with self._jit_scope():
+                self.build_resnet_generator()
         else:
             raise("Should use resnet")
 
@@ -626,8 +719,9 @@ class BalancingGAN:
         fake_images = Input(shape=(self.resolution, self.resolution, self.channels))
 
         if self.loss_type != 'categorical':
-            real_output_for_d = self.discriminator(real_images)
-            fake_output_for_d = self.discriminator(fake_images)
+            with self._jit_scope():
+                real_output_for_d = self.discriminator(real_images)
+                fake_output_for_d = self.discriminator(fake_images)
 
             self.discriminator_fake = Model(
                 inputs = [fake_images],
@@ -652,31 +746,83 @@ class BalancingGAN:
             )
 
         # Define combined for training generator.
-        real_images_for_G = Input((self.k_shot, self.resolution, self.resolution, 3))
-         # real attr
-        attr_features = self.get_attribute_tensor(real_images_for_G, average=False)
-        fake = self.generator([
-            attr_features, latent_code
-        ])
+        real_images_for_G = Input((self.k_shot, self.resolution, self.resolution, self.channels))
+        negative_samples = Input((self.resolution,self.resolution,self.channels))
 
         self.discriminator.trainable = False
+        self.discriminator_multi.trainable = False
         self.generator.trainable = True
         self.features_from_d_model.trainable = False
 
-        aux_fake = self.discriminator(fake)
-
-        negative_samples = Input((self.resolution,self.resolution,self.channels))
-        fake_attribute = self.latent_encoder(self._triple_tensor(fake))
+        with self._jit_scope():
+            aux_fake, generator_losses = self._generator_losses(
+                real_images_for_G, negative_samples, latent_code)
 
         self.combined = Model(
             inputs=[real_images_for_G, negative_samples, latent_code],
             outputs=aux_fake,
             name = 'Combined',
         )
+        for loss in generator_losses:
+            self.combined.add_loss(loss)
+
+        self.combined.compile(
+            optimizer=Adam(
+                lr=self.g_lr,
+                beta_1=self.adam_beta_1
+            ),
+            metrics=['accuracy'],
+            loss = self.g_loss,
+        )
+        self._show_settings()
+
+    def _jit_scope(self):
+        """
+        Scope compiling the ops built in it, and their gradients, with the
+        XLA JIT when xla is set. Keras models called in the scope get their
+        ops of this call compiled, ops without an XLA kernel are left out of
+        the compiled clusters.
+        """
+        if self.xla:
+            return tf.contrib.compiler.jit.experimental_jit_scope()
+        return contextlib.suppress()
+
+    def _generator_losses(self, real_images_for_G, negative_samples, latent_code):
+        """
+        Discriminator output for the fakes of the generator and the advance
+        losses of the generator
+        real_images_for_G: (batch, k_shot, h, w, c) support images
+        return: aux_fake, list of weighted loss tensors
+        """
+         # real attr, (batch, k_shot, latent_size)
+        attr_features = self.get_attribute_tensor(real_images_for_G, average=False)
+        fake = self.generator([
+            Lambda(lambda x: K.mean(x, axis=1))(attr_features), latent_code
+        ])
+
+        # one discriminator pass over the fakes, the negatives and the shots
+        # (only use 1 channel), in this order
+        shots = Lambda(lambda x: K.reshape(
+            x[..., :self.channels],
+            (-1, self.resolution, self.resolution, self.channels)
+        ))(real_images_for_G)
+        aux, d_features = self.discriminator_multi(
+            Concatenate(axis=0)([fake, negative_samples, shots]))
+        # the batch is split in 1 + 1 + k_shot parts
+        parts = self.k_shot + 2
+        aux_fake = Lambda(lambda x: x[:K.shape(x)[0] // parts])(aux)
+        batch_size = K.shape(d_features)[0] // parts
+        fake_fm = d_features[:batch_size]
+        negative_fm = d_features[batch_size:2 * batch_size]
+        fm_features = K.reshape(d_features[2 * batch_size:],
+                                (-1, self.k_shot, self.d_feature_size))
+
+        fake_attribute = self.latent_encoder(self._triple_tensor(fake))
+        losses = []
 
         # triplet function
         margin = 1.0
-        if 'triplet' in advance_losses:
+        if 'triplet' in self.advance_losses:
             print("Triplet OP")
             k_op = K.sum
             metric_op = K.square
@@ -687,13 +833,9 @@ class BalancingGAN:
             # metric_op = cosine_sim_op
             metric_op = K.square
 
-        if len(attr_features.shape) < 5:
-            d_pos = k_op(metric_op(fake_attribute - attr_features), axis=1)
-        else:
-            d_pos = Average()([
-                k_op(metric_op(fake_attribute - attr_feature), axis=1) \
-                    for attr_feature in attr_features
-            ])
+        # distance to every shot, averaged over the shots
+        d_pos = K.mean(k_op(metric_op(
+            K.expand_dims(fake_attribute, axis=1) - attr_features), axis=2), axis=1)
         d_neg = k_op(metric_op(
                 fake_attribute -
                 self.latent_encoder(self._triple_tensor(negative_samples))
@@ -703,62 +845,32 @@ class BalancingGAN:
 
 
         # Feature matching from D net
-        fm_features = [
-            # Only use 1 channel
-            self.features_from_d_model(Lambda(lambda x: x[:, i,:,:,:self.channels])(real_images_for_G)) \
-                for i in range(self.k_shot)
-        ]
-
-        fake_fm = self.features_from_d_model(fake)
-
-        if 'triplet_D' in advance_losses:
+        if 'triplet_D' in self.advance_losses:
             k_op_d = K.sum
         else:
             k_op_d =  K.mean
 
-        if len(fm_features) == 1:
-            fm_D = k_op_d(K.square(fake_fm - fm_features[0]), axis=1)
-        else:
-            fm_D = Average()([
-                k_op_d(K.square(fake_fm - fm_feature), axis=1) \
-                    for fm_feature in fm_features
-            ])
+        fm_D = K.mean(k_op_d(K.square(
+            K.expand_dims(fake_fm, axis=1) - fm_features), axis=2), axis=1)
 
-        fm_D_neg = k_op_d(K.square(fake_fm - self.features_from_d_model(negative_samples)), axis=1)
+        fm_D_neg = k_op_d(K.square(fake_fm - negative_fm), axis=1)
         triplet_D = K.maximum(fm_D - fm_D_neg + margin, 0.0)
         # Recontruction loss
-        real_imgs = [
-            Lambda(lambda x: x[:,i,:,:,:self.channels])(real_images_for_G) \
-                for i in range(self.k_shot)
-        ]
-        if len(real_imgs) == 1:
-            recontruction_loss = K.square(fake - real_imgs[0])
-        else:
-            recontruction_loss = Average()([
-                K.square(fake - real_img) \
-                    for real_img in real_imgs
-            ])
-
-        if 'triplet' in advance_losses:
-            self.combined.add_loss(advance_losses['triplet'] * triplet)
-        if 'l2_feat' in advance_losses:
-            self.combined.add_loss(advance_losses['l2_feat'] * d_pos)
-        if 'fm_D' in advance_losses:
-            self.combined.add_loss(advance_losses['fm_D'] *fm_D)
-        if 'triplet_D' in advance_losses:
-            self.combined.add_loss(advance_losses['triplet_D'] * triplet_D)
-        if 'recon' in advance_losses:
-            self.combined.add_loss(advance_losses['recon'] * K.mean(recontruction_loss))
-
-        self.combined.compile(
-            optimizer=Adam(
-                lr=self.g_lr,
-                beta_1=self.adam_beta_1
-            ),
-            metrics=['accuracy'],
-            loss = self.g_loss,
-        )
-        self._show_settings()
+        real_imgs = Lambda(lambda x: x[..., :self.channels])(real_images_for_G)
+        recontruction_loss = K.mean(
+            K.square(K.expand_dims(fake, axis=1) - real_imgs), axis=1)
+
+        if 'triplet' in self.advance_losses:
+            losses.append(self.advance_losses['triplet'] * triplet)
+        if 'l2_feat' in self.advance_losses:
+            losses.append(self.advance_losses['l2_feat'] * d_pos)
+        if 'fm_D' in self.advance_losses:
+            losses.append(self.advance_losses['fm_D'] *fm_D)
+        if 'triplet_D' in self.advance_losses:
+            losses.append(self.advance_losses['triplet_D'] * triplet_D)
+        if 'recon' in self.advance_losses:
+            losses.append(self.advance_losses['recon'] * K.mean(recontruction_loss))
+        return aux_fake, losses
 
     def build_resnet_generator(self):
         init_channels = 2 * self.resolution
@@ -929,6 +1041,7 @@ class BalancingGAN:
 
         features = self._discriminator_feature(image)
         features = Dropout(0.4)(features)
+        self.d_feature_size = K.int_shape(features)[-1]
         activation = 'sigmoid' if self.loss_type == 'binary' else 'linear'
         last_channels = 1
         if self.loss_type == 'categorical':
@@ -942,19 +1055,17 @@ class BalancingGAN:
         self.discriminator = Model(inputs=image,
                                    outputs=aux,
                                    name='discriminator')
+        # same layers, with the features of the auxiliary layer as second output
+        self.discriminator_multi = Model(inputs=image,
+                                         outputs=[aux, features],
+                                         name='discriminator_multi')
 
 
     def generate_latent(self, c, size = 1):
         if self.sampling == 'code':
-            return np.array([
-                np.random.multivariate_normal(self.means[e], self.covariances[e])
-                for e in c
-            ])
+            return self.latent_sampler.sample(c)
 
-        return np.array([
-            np.random.normal(0, 1, self.latent_size)
-            for i in c
-        ])
+        return np.random.normal(0, 1, (len(c), self.latent_size))
 
 
     def build_features_from_d_model(self):
@@ -967,59 +1078,472 @@ class BalancingGAN:
     def _norm(self):
         return BatchNormalization() if 'batch' in self.norm else InstanceNormalization()
 
-    def _train_one_epoch(self, bg_train):
-        epoch_disc_loss = []
-        epoch_gen_loss = []
-        class_weight = bg_train.class_weights
-        for image_batch, label_batch in bg_train.next_batch():
-            crt_batch_size = label_batch.shape[0]
+    def _real_for_G(self, images):
+        """
+        Real batch as the k-shot input of the combined model, every sample
+        is repeated k_shot times as in _build_graph_step
+        return: read-only (batch, k_shot, h, w, c) view of images
+        """
+        return np.broadcast_to(images[:, None],
+                               (len(images), self.k_shot) + images.shape[1:])
 
-            ################## Train Discriminator ##################
-            fake_size = crt_batch_size // self.nclasses
-            f = self.generate_latent(label_batch)
-            k_shot_batch = bg_train.ramdom_kshot_images(self.k_shot, label_batch)
-            for i in range(self.D_RATE):
-                generated_images = self.generate(k_shot_batch, f)
+    def _step_inputs(self, bg_train, plan, step, buf):
+        """
+        Fill buf with the inputs of a training step, batches have a fixed
+        size so the arrays of buf are reused
+        """
+        batch = plan.batch_slice(step)
+        ids = plan.ids[batch]
+        buf['labels'] = plan.labels[batch]
+        buf['images'] = bg_train.batch_images(ids, out=buf.get('images'))
+        buf['real'] = self._real_for_G(buf['images'])
+        # fakes are generated from the cached codes of the supports
+        buf['support_codes'] = self.support_codes(bg_train, plan.support[batch])
+        buf['negatives'] = bg_train.get_images(plan.negatives[batch],
+                                               out=buf.get('negatives'))
+        buf['latent_d'] = self.generate_latent(buf['labels'])
+        buf['latent_g'] = self.generate_latent(buf['labels'])
+
+    def _tf_data_steps(self, bg_train):
+        """
+        Step inputs of one epoch read from the tf.data pipeline of bg_train
+        """
+        negatives = self._negative_sampler(bg_train)
+        if bg_train not in self._tf_inputs:
+            dataset = bg_train.as_tf_dataset(self.k_shot,
+                                              prefetch=max(self.prefetch, 1),
+                                              negatives=negatives)
+            self._tf_inputs[bg_train] = dataset.make_one_shot_iterator().get_next()
+        next_element = self._tf_inputs[bg_train]
+        sess = K.get_session()
+        for _ in range(bg_train.get_num_samples() // bg_train.batch_size):
+            images, labels, support, negatives = sess.run(next_element)
+            yield {
+                'images': images,
+                'labels': labels,
+                'real': self._real_for_G(images),
+                'support': support,
+                'negatives': negatives,
+                'latent_d': self.generate_latent(labels),
+                'latent_g': self.generate_latent(labels),
+            }
+
+    def _build_graph_step(self, bg):
+        """
+        Training functions of D and G reading their batches from a
+        GraphDataset of bg. They take [sample ids, latent codes, learning phase].
+        The fakes of the D step are generated in training mode, in the graph.
+        """
+        data = graph_data.GraphDataset(bg, self.k_shot)
+        inputs = [data.ids, K.placeholder((None, self.latent_size)), K.learning_phase()]
+        d_optimizer = lambda: Adam(lr=self.adam_lr, beta_1=self.adam_beta_1)
 
-                # X, aux_y = self.shuffle_data(X, aux_y)
-                fake_label = np.ones((crt_batch_size, 1))
-                real_label = -np.ones((crt_batch_size, 1))
+        self.discriminator.trainable = True
+        d_weights = self.discriminator.trainable_weights
+        self.discriminator.trainable = False
 
+        with self._jit_scope():
+            fake = K.stop_gradient(self.generator([
+                self.get_attribute_tensor(data.support), inputs[1]
+            ]))
+        real = data.batch_images
+        steps = {}
+        if self.loss_type == 'categorical':
+            class_weight = K.constant([
+                bg.class_weights[c] for c in range(self.nclasses + 1)
+            ])
+            targets = K.concatenate([
+                data.labels, K.cast(K.ones_like(data.labels) * self.nclasses, 'int64')
+            ])
+            with self._jit_scope():
+                out = self.discriminator(K.concatenate([real, fake], axis=0))
+            loss = K.mean(
+                K.gather(class_weight, targets) *
+                keras.losses.sparse_categorical_crossentropy(targets, out))
+            acc = K.mean(keras.metrics.sparse_categorical_accuracy(targets, out))
+            steps['d'] = K.function(
+                inputs, [loss, acc],
+                updates=d_optimizer().get_updates(loss, d_weights))
+            real_label = data.labels
+        else:
+            with self._jit_scope():
+                d_fake = self.discriminator(fake)
+                d_real = self.discriminator(real)
+            real_label = -K.ones_like(d_real)
+            if self.loss_type == 'binary':
+                real_label *= 0
+            for name, output, label, loss_fn in [
+                    ('d_fake', d_fake, K.ones_like(d_fake), self.d_fake_loss),
+                    ('d_real', d_real, real_label, self.d_real_loss)]:
+                loss = K.mean(loss_fn(label, output))
+                acc = K.mean(keras.metrics.binary_accuracy(label, output))
+                steps[name] = K.function(
+                    inputs, [loss, acc],
+                    updates=d_optimizer().get_updates(loss, d_weights))
+
+        # G is conditioned on the real batch, as the combined model
+        real_for_G = K.tile(K.expand_dims(real, axis=1), [1, self.k_shot, 1, 1, 1])
+        with self._jit_scope():
+            aux_fake, losses = self._generator_losses(real_for_G, data.negatives, inputs[1])
+        g_loss, g_acc = self._g_total_loss(aux_fake, losses, real_label,
+                                           class_weight if self.loss_type == 'categorical' else None)
+        g_updates = Adam(lr=self.g_lr, beta_1=self.adam_beta_1).get_updates(
+            g_loss, self.combined.trainable_weights)
+        g_updates += self.generator.get_updates_for(self.generator.get_input_at(-1))
+        steps['g'] = K.function(inputs, [K.mean(g_loss), K.mean(g_acc)],
+                                updates=g_updates)
+        return steps
+
+    def _g_total_loss(self, aux_fake, losses, real_label, class_weight=None):
+        """
+        Loss of the combined model as compiled: adversarial loss plus the
+        advance losses
+        class_weight: tensor of the class weights for the categorical loss
+        return: loss tensor, accuracy tensor
+        """
+        if self.loss_type == 'categorical':
+            g_loss = K.gather(class_weight, real_label) * \
+                keras.losses.sparse_categorical_crossentropy(real_label, aux_fake)
+            g_acc = keras.metrics.sparse_categorical_accuracy(real_label, aux_fake)
+        else:
+            g_loss = self.g_loss(real_label, aux_fake)
+            g_acc = keras.metrics.binary_accuracy(real_label, aux_fake)
+        g_loss = K.mean(g_loss)
+        for loss in losses:
+            g_loss = g_loss + loss
+        return g_loss, K.mean(g_acc)
+
+    def _step_placeholders(self, block=None):
+        """
+        Placeholders of the fused step inputs: images, labels, support codes,
+        D latents, real images for G, negatives and G latents
+        block: number of steps of a block of inputs, None for a single step
+        """
+        lead = (None,) if block is None else (block, None)
+        image_shape = (self.resolution, self.resolution, self.channels)
+        return [
+            K.placeholder(lead + image_shape),
+            K.placeholder(lead, dtype='int64'),
+            K.placeholder(lead + (self.latent_size,)),
+            K.placeholder(lead + (self.latent_size,)),
+            K.placeholder(lead + (self.k_shot,) + image_shape),
+            K.placeholder(lead + image_shape),
+            K.placeholder(lead + (self.latent_size,)),
+        ]
+
+    def _fused_optimizers(self):
+        """
+        D and G optimizers of the fused steps, shared by the single and
+        multi-step functions
+        """
+        if self._optimizers is None:
+            self._optimizers = (
+                tf.train.AdamOptimizer(self.adam_lr, beta1=self.adam_beta_1,
+                                       epsilon=K.epsilon()),
+                tf.train.AdamOptimizer(self.g_lr, beta1=self.adam_beta_1,
+                                       epsilon=K.epsilon()),
+            )
+        return self._optimizers
+
+    def _fused_graph(self, bg, images, labels, support_codes, latent_d,
+                     real_for_G, negatives, latent_g):
+        """
+        Graph of a fused step: D is trained on the concatenated real and fake
+        batch with one optimizer, then G against the updated D, as the
+        train_on_batch step does. The fakes for D are generated in inference
+        mode, as generate does. With simultaneous_update, the G loss uses D
+        at the start of the step and both updates are applied together.
+        return: D loss, D accuracy, G loss, G accuracy, train op
+        """
+        # forwards and gradients are compiled, the variable updates are not
+        with self._jit_scope():
+            with tf.keras.backend.learning_phase_scope(0):
+                fake = self.generator([support_codes, latent_d])
+            d_out = self.discriminator(
+                K.concatenate([images, K.stop_gradient(fake)], axis=0))
+            class_weight = None
+            if self.loss_type == 'categorical':
+                class_weight = K.constant([
+                    bg.class_weights[c] for c in range(self.nclasses + 1)
+                ])
+                targets = K.concatenate([labels, K.ones_like(labels) * self.nclasses])
+                d_loss = K.mean(
+                    K.gather(class_weight, targets) *
+                    keras.losses.sparse_categorical_crossentropy(targets, d_out))
+                d_acc = K.mean(keras.metrics.sparse_categorical_accuracy(targets, d_out))
+                real_label = labels
+            else:
+                batch_size = K.shape(images)[0]
+                d_real, d_fake = d_out[:batch_size], d_out[batch_size:]
+                real_label = -K.ones_like(d_real)
                 if self.loss_type == 'binary':
                     real_label *= 0
+                fake_label = K.ones_like(d_fake)
+                d_loss = 0.5 * (K.mean(self.d_real_loss(real_label, d_real)) +
+                                K.mean(self.d_fake_loss(fake_label, d_fake)))
+                d_acc = K.mean(keras.metrics.binary_accuracy(
+                    K.concatenate([real_label, fake_label], axis=0), d_out))
+
+            self.discriminator.trainable = True
+            d_weights = self.discriminator.trainable_weights
+            self.discriminator.trainable = False
+            d_optimizer, g_optimizer = self._fused_optimizers()
+            d_grads = d_optimizer.compute_gradients(d_loss, d_weights)
+
+        d_train = []
+        if not self.simultaneous_update:
+            # the G forward reads D after its update
+            d_train = [d_optimizer.apply_gradients(d_grads)]
+        with tf.control_dependencies(d_train):
+            with self._jit_scope():
+                aux_fake, losses = self._generator_losses(real_for_G, negatives, latent_g)
+                g_loss, g_acc = self._g_total_loss(aux_fake, losses, real_label, class_weight)
+                g_grads = g_optimizer.compute_gradients(
+                    g_loss, self.combined.trainable_weights)
+        bn_updates = [
+            tf.assign(*u) if isinstance(u, tuple) else u
+            for u in self.generator.get_updates_for(self.generator.get_input_at(-1))
+        ]
+        grads = [g for g, _ in g_grads if g is not None]
+        if self.simultaneous_update:
+            grads += [g for g, _ in d_grads if g is not None]
+        with tf.control_dependencies(grads):
+            if self.simultaneous_update:
+                d_train = [d_optimizer.apply_gradients(d_grads)]
+            train_op = tf.group(g_optimizer.apply_gradients(g_grads),
+                                *(d_train + bn_updates))
+        return d_loss, d_acc, K.mean(g_loss), g_acc, train_op
+
+    def _build_fused_step(self, bg):
+        """
+        Function running a fused step (see _fused_graph) in one session call.
+        Inputs are the step inputs (see _step_placeholders) and the learning phase.
+        """
+        inputs = self._step_placeholders()
+        d_loss, d_acc, g_loss, g_acc, train_op = self._fused_graph(bg, *inputs)
+        return K.function(inputs + [K.learning_phase()],
+                          [d_loss, d_acc, g_loss, g_acc], updates=[train_op])
+
+    def _build_multi_step(self, bg):
+        """
+        Function running steps_per_call fused steps in one session call,
+        with a tf.while_loop over a block of step inputs. The losses are
+        summed in the loop and returned as block means.
+        Inputs are the blocks of step inputs (see _step_placeholders) and
+        the learning phase.
+        """
+        # the optimizer slots are created outside of the loop, by the single step
+        if bg not in self._fused_steps:
+            self._fused_steps[bg] = self._build_fused_step(bg)
+        nb_steps = self.steps_per_call
+        blocks = self._step_placeholders(nb_steps)
+
+        def body(i, d_sum, g_sum):
+            d_loss, d_acc, g_loss, g_acc, train_op = self._fused_graph(
+                bg, *[block[i] for block in blocks])
+            with tf.control_dependencies([train_op]):
+                return i + 1, d_sum + d_loss, g_sum + g_loss
+
+        _, d_sum, g_sum = tf.while_loop(
+            lambda i, d_sum, g_sum: i < nb_steps, body,
+            [tf.constant(0), tf.constant(0.0), tf.constant(0.0)],
+            back_prop=False)
+        return K.function(blocks + [K.learning_phase()],
+                          [d_sum / nb_steps, g_sum / nb_steps])
+
+    def _train_block(self, bg_train, block):
+        """
+        Train on a list of steps_per_call step inputs in one session call
+        return: mean D loss, mean G loss of the block
+        """
+        if bg_train not in self._multi_steps:
+            self._multi_steps[bg_train] = self._build_multi_step(bg_train)
+        for inputs in block:
+            if 'support_codes' not in inputs:
+                inputs['support_codes'] = self.latent_codes(inputs['support'])
+        keys = ['images', 'labels', 'support_codes', 'latent_d',
+                'real', 'negatives', 'latent_g']
+        return self._multi_steps[bg_train](
+            [np.stack([inputs[k] for inputs in block]) for k in keys] + [1])
+
+    def _train_step_fused(self, bg_train, inputs):
+        """
+        One D and one G update in a single session call, see _build_fused_step
+        return: D loss, G loss
+        """
+        if bg_train not in self._fused_steps:
+            self._fused_steps[bg_train] = self._build_fused_step(bg_train)
+        if 'support_codes' in inputs:
+            codes = inputs['support_codes']
+        else:
+            codes = self.latent_codes(inputs['support'])
+        d_loss, d_acc, g_loss, g_acc = self._fused_steps[bg_train]([
+            inputs['images'], inputs['labels'], codes, inputs['latent_d'],
+            inputs['real'], inputs['negatives'], inputs['latent_g'], 1
+        ])
+        return d_loss, g_loss
+
+    def benchmark_train_step(self, bg_train, steps=50, warmup=5):
+        """
+        Steps per second of the train_on_batch step, of the fused step and,
+        with steps_per_call > 1, of the multi-step block, on the same
+        prepared inputs. The models are trained on these steps.
+        return: dict step name -> steps per second
+        """
+        self.attribute_codes(bg_train)
+        plan = bg_train.epoch_plan(self.k_shot, negatives=True)
+        if len(plan) <= warmup:
+            raise ValueError('The epoch plan has {} steps, more than {} warmup '
+                             'steps are needed'.format(len(plan), warmup))
+        nb_steps = min(len(plan), warmup + steps)
+        step_inputs = []
+        for step in range(nb_steps):
+            buf = {}
+            self._step_inputs(bg_train, plan, step, buf)
+            step_inputs.append(buf)
+
+        res = {}
+        for name, train_step in [('train_on_batch', self._train_step),
+                                 ('fused', self._train_step_fused)]:
+            for inputs in step_inputs[:warmup]:
+                train_step(bg_train, inputs)
+            start = datetime.datetime.now()
+            for inputs in step_inputs[warmup:]:
+                train_step(bg_train, inputs)
+            elapsed = (datetime.datetime.now() - start).total_seconds()
+            res[name] = (nb_steps - warmup) / elapsed
+            print('{}: {:.2f} steps/s'.format(name, res[name]))
+
+        blocks = [step_inputs[i:i + self.steps_per_call]
+                  for i in range(0, nb_steps - self.steps_per_call + 1,
+                                 self.steps_per_call)]
+        if self.steps_per_call > 1 and len(blocks) < 2:
+            logger.warn('{} steps are too few to time blocks of {} steps'.format(
+                nb_steps, self.steps_per_call))
+        elif self.steps_per_call > 1:
+            # the first block builds the loop and warms it up
+            self._train_block(bg_train, blocks[0])
+            start = datetime.datetime.now()
+            for block in blocks[1:]:
+                self._train_block(bg_train, block)
+            elapsed = (datetime.datetime.now() - start).total_seconds()
+            name = 'multi_{}'.format(self.steps_per_call)
+            res[name] = (len(blocks) - 1) * self.steps_per_call / elapsed
+            print('{}: {:.2f} steps/s'.format(name, res[name]))
+        return res
+
+    def _train_one_epoch_graph(self, bg_train):
+        """
+        Train one epoch on the in-graph dataset of bg_train, only the sample
+        ids of the epoch plan and the latent codes are fed
+        """
+        if bg_train not in self._graph_steps:
+            self._graph_steps[bg_train] = self._build_graph_step(bg_train)
+        steps = self._graph_steps[bg_train]
+
+        epoch_disc_loss = []
+        epoch_gen_loss = []
+        for ids, label_batch in bg_train.epoch_plan():
+            for i in range(self.D_RATE):
+                f = self.generate_latent(label_batch)
                 if self.loss_type == 'categorical':
-                    real_label = label_batch
-                    loss, acc = self.discriminator.train_on_batch(
-                        np.concatenate([image_batch, generated_images], axis=0),
-                        np.concatenate([
-                            real_label,
-                            np.full(crt_batch_size, self.nclasses)], axis=0),
-                        class_weight=class_weight,
-                    )
+                    loss, acc = steps['d']([ids, f, 1])
                 else:
-                    loss_fake, acc_fake, *rest = \
-                            self.discriminator_fake.train_on_batch([generated_images],
-                                                                    fake_label)
-                    loss_real, acc_real, *rest = \
-                            self.discriminator_real.train_on_batch([image_batch],
-                                                                    real_label)
+                    loss_fake, acc_fake = steps['d_fake']([ids, f, 1])
+                    loss_real, acc_real = steps['d_real']([ids, f, 1])
                     loss = 0.5 * (loss_fake + loss_real)
-                    acc = 0.5 * (acc_fake + acc_real)
-
             epoch_disc_loss.append(loss)
 
-            ################## Train Generator ##################
-            f = self.generate_latent(label_batch)
-            negative_samples = bg_train.get_samples_by_labels(bg_train.other_labels(label_batch))
-            gloss, gacc = self.combined.train_on_batch(
-                [
-                    utils.triple_channels(np.expand_dims(image_batch, axis=1)),
-                    negative_samples, f
-                ],
-                real_label,
-                class_weight=class_weight if self.loss_type == 'categorical' else None
-            )
+            gloss, gacc = steps['g']([ids, self.generate_latent(label_batch), 1])
+            epoch_gen_loss.append(gloss)
+
+        return (
+            np.mean(np.array(epoch_disc_loss), axis=0),
+            np.mean(np.array(epoch_gen_loss), axis=0),
+        )
+
+    def encode_dataset(self, bg, chunk_size=2048):
+        """
+        Latent encoder codes of every sample of bg
+        """
+        size = bg.get_num_samples()
+        codes = np.empty((size, self.latent_size), dtype=np.float32)
+        for start in range(0, size, chunk_size):
+            ids = np.arange(start, min(start + chunk_size, size))
+            codes[ids] = self.latent_code(bg.get_images(ids))
+        return codes
+
+    def attribute_codes(self, bg):
+        """
+        Latent encoder codes of every sample of bg, computed once per
+        encoder and dataset and cached on disk
+        """
+        if bg not in self._attribute_codes:
+            fname = '{}/{}/attribute_codes/{}_{}_{}.npy'.format(
+                BASE_DIR, self.dataset, self.resolution,
+                self.latent_encoder_key[:16], bg.fingerprint()[:16])
+            local = staging.fetch(fname)
+            if os.path.exists(local):
+                codes = np.load(local)
+            else:
+                codes = self.encode_dataset(bg)
+                np.save(staging.write_path(fname), codes)
+                staging.push(fname)
+            self._attribute_codes[bg] = codes
+        return self._attribute_codes[bg]
+
+    def support_codes(self, bg, support_ids):
+        """
+        Attribute codes of (batch, k_shot) support ids of bg, averaged over the shots
+        """
+        return self.attribute_codes(bg)[support_ids].mean(axis=1)
+
+    def _negative_sampler(self, bg):
+        """
+        Negative sampling of the epoch plans of bg: True for uniform
+        negatives, else a function drawing hard negatives of the labels
+        """
+        if not self.hard_negatives:
+            return True
+        if bg not in self._hard_negative_index:
+            # built from the codes of the frozen latent encoder, they never change
+            self._hard_negative_index[bg] = samplers.HardNegativeIndex(
+                bg.class_index, self.attribute_codes(bg), self.hard_negatives)
+        return self._hard_negative_index[bg].draw
 
+    def _train_one_epoch(self, bg_train):
+        if self.input_pipeline == 'graph':
+            return self._train_one_epoch_graph(bg_train)
+        epoch_disc_loss = []
+        epoch_gen_loss = []
+        if self.input_pipeline == 'tf.data':
+            steps = self._tf_data_steps(bg_train)
+        else:
+            # computed here, the prefetch thread only gathers them
+            self.attribute_codes(bg_train)
+            # supports and negatives of the whole epoch are drawn with the batches
+            plan = bg_train.epoch_plan(self.k_shot,
+                                       negatives=self._negative_sampler(bg_train))
+            steps = prefetch.Prefetcher(
+                lambda step, buf: self._step_inputs(bg_train, plan, step, buf),
+                len(plan), self.prefetch)
+        train_step = self._train_step_fused if self.fused_step else self._train_step
+        if self.steps_per_call > 1:
+            # the losses of a block are its mean, weighted as its steps
+            block = []
+            for inputs in steps:
+                block.append({k: np.array(v) for k, v in inputs.items()})
+                if len(block) == self.steps_per_call:
+                    loss, gloss = self._train_block(bg_train, block)
+                    epoch_disc_loss += [loss] * len(block)
+                    epoch_gen_loss += [gloss] * len(block)
+                    block = []
+            # steps left at the end of the epoch
+            steps = block
+            train_step = self._train_step_fused
+        for inputs in steps:
+            loss, gloss = train_step(bg_train, inputs)
+            epoch_disc_loss.append(loss)
             epoch_gen_loss.append(gloss)
 
         return (
@@ -1027,6 +1551,58 @@ class BalancingGAN:
             np.mean(np.array(epoch_gen_loss), axis=0),
         )
 
+    def _train_step(self, bg_train, inputs):
+        """
+        One D and one G update with train_on_batch
+        return: D loss, G loss
+        """
+        class_weight = bg_train.class_weights
+        image_batch, label_batch = inputs['images'], inputs['labels']
+        crt_batch_size = label_batch.shape[0]
+
+        ################## Train Discriminator ##################
+        fake_size = crt_batch_size // self.nclasses
+        f = inputs['latent_d']
+        for i in range(self.D_RATE):
+            if 'support_codes' in inputs:
+                generated_images = self.generator.predict(
+                    [inputs['support_codes'], f])
+            else:
+                generated_images = self.generate(inputs['support'], f)
+
+            # X, aux_y = self.shuffle_data(X, aux_y)
+            fake_label = np.ones((crt_batch_size, 1))
+            real_label = -np.ones((crt_batch_size, 1))
+
+            if self.loss_type == 'binary':
+                real_label *= 0
+            if self.loss_type == 'categorical':
+                real_label = label_batch
+                loss, acc = self.discriminator.train_on_batch(
+                    np.concatenate([image_batch, generated_images], axis=0),
+                    np.concatenate([
+                        real_label,
+                        np.full(crt_batch_size, self.nclasses)], axis=0),
+                    class_weight=class_weight,
+                )
+            else:
+                loss_fake, acc_fake, *rest = \
+                        self.discriminator_fake.train_on_batch([generated_images],
+                                                                fake_label)
+                loss_real, acc_real, *rest = \
+                        self.discriminator_real.train_on_batch([image_batch],
+                                                                real_label)
+                loss = 0.5 * (loss_fake + loss_real)
+                acc = 0.5 * (acc_fake + acc_real)
+
+        ################## Train Generator ##################
+        gloss, gacc = self.combined.train_on_batch(
+            [inputs['real'], inputs['negatives'], inputs['latent_g']],
+            real_label,
+            class_weight=class_weight if self.loss_type == 'categorical' else None
+        )
+        return loss, gloss
+
     def shuffle_data(self, data_x, data_y):
         rd_idx = np.arange(data_x.shape[0])
         np.random.shuffle(rd_idx)
@@ -1053,9 +1629,11 @@ class BalancingGAN:
 
         # Load last bck
         try:
-            self.generator.load_weights(os.path.join(self.res_dir, generator_fname))
+            self.generator.load_weights(
+                staging.fetch(os.path.join(self.res_dir, generator_fname)))
             logger.info("generator weigths loaded")
-            self.discriminator.load_weights(os.path.join(self.res_dir, discriminator_fname))
+            self.discriminator.load_weights(
+                staging.fetch(os.path.join(self.res_dir, discriminator_fname)))
             logger.info("discriminator weigths loaded")
             return epoch
 
@@ -1064,7 +1642,8 @@ class BalancingGAN:
             try:
                 utils.set_weights(self.generator, self.res_dir)
                 logger.info("generator weigths loaded manually")
-                self.discriminator.load_weights(os.path.join(self.res_dir, discriminator_fname))
+                self.discriminator.load_weights(
+                    staging.fetch(os.path.join(self.res_dir, discriminator_fname)))
                 logger.info("discriminator weigths loaded")
             except Exception as err:
                 e += '\n, Load weigths array error ' + str(err)
@@ -1082,8 +1661,10 @@ class BalancingGAN:
         discriminator_fname = "{}/bck_discriminator.h5".format(self.res_dir)
 
         # utils.save_weights(self.generator, self.res_dir)
-        self.generator.save(generator_fname)
-        self.discriminator.save(discriminator_fname)
+        self.generator.save(staging.write_path(generator_fname))
+        self.discriminator.save(staging.write_path(discriminator_fname))
+        staging.push(generator_fname)
+        staging.push(discriminator_fname)
 
     def plot_cm_for_G(self, bg, bg_test=None, labels=None, metric='l2'):
         if labels is None:
@@ -1144,16 +1725,11 @@ class BalancingGAN:
 
 
     def generate(self, images, latent):
-        attr_codes = [
-            self.latent_code(images[:,i, ]) \
-                for i in range(self.k_shot)
-        ]
-        if len(attr_codes) == 1:
-            attr_code = attr_codes[0]
-        else:
-            attr_code = np.mean(attr_codes, axis=1)
+        """
+        images: (batch, k_shot, h, w, c) supports, encoded in one pass
+        """
         return self.generator.predict([
-            attr_code, latent
+            self.latent_codes(images), latent
         ])
 
     def train(self, bg_train, bg_test, epochs=50):
@@ -1169,7 +1745,7 @@ class BalancingGAN:
             crt_c = 0
             # act_img_samples = bg_train.get_samples_for_class(crt_c, 10)
             act_img_samples = bg_train.ramdom_kshot_images(self.k_shot,
-                                                        np.full(10, crt_c))
+                                                        np.full(10, bg_train.classes[crt_c]))
             f = self.generate_latent([crt_c] * 10)
             img_samples = np.array([
                 [
@@ -1181,7 +1757,7 @@ class BalancingGAN:
             for crt_c in range(1, min(self.nclasses, 3)): # more 3 classes
                 # act_img_samples = bg_train.get_samples_for_class(crt_c, 10)
                 act_img_samples = bg_train.ramdom_kshot_images(self.k_shot,
-                                                            np.full(10, crt_c))
+                                                            np.full(10, bg_train.classes[crt_c]))
                 new_samples = np.array([
                     [
                         # batch, k_shot, h, w, c
@@ -1204,7 +1780,7 @@ class BalancingGAN:
                 random_ids = np.arange(bg_train.dataset_y.shape[0])
                 np.random.shuffle(random_ids)
                 random_ids = random_ids[:test_size]
-                test_batch_x = bg_train.dataset_x[random_ids]
+                test_batch_x = bg_train.get_images(random_ids)
                 test_batch_y = bg_train.dataset_y[random_ids]
                 k_shot_test_batch = bg_train.ramdom_kshot_images(self.k_shot, test_batch_y)
                 f = self.generate_latent(test_batch_y)
@@ -1267,7 +1843,7 @@ class BalancingGAN:
                     crt_c = 0
                     # act_img_samples = bg_train.get_samples_for_class(crt_c, 10)
                     act_img_samples = bg_train.ramdom_kshot_images(self.k_shot,
-                                                                   np.full(10, crt_c))
+                                                                   np.full(10, bg_train.classes[crt_c]))
 
                     f = self.generate_latent([crt_c] * 10)
                     img_samples = np.array([
@@ -1282,7 +1858,7 @@ class BalancingGAN:
                     for crt_c in range(1, min(self.nclasses, 3)):
                         # act_img_samples = bg_train.get_samples_for_class(crt_c, 10)
                         act_img_samples = bg_train.ramdom_kshot_images(self.k_shot,
-                                                                   np.full(10, crt_c))
+                                                                   np.full(10, bg_train.classes[crt_c]))
                         f = self.generate_latent([crt_c] * 10)
                         new_samples = np.array([
                             [
@@ -1319,8 +1895,16 @@ class BalancingGAN:
 
             self.trained = True
 
-    def plot_feature_distr(self, bg, size=500):
-        x, y = bg.dataset_x, bg.dataset_y
+    def plot_feature_distr(self, bg, size=500, nb_real=2000):
+        """
+        nb_real: number of random real samples plotted, the whole dataset
+                 may not fit in memory as float32
+        """
+        ids = np.random.choice(bg.get_num_samples(),
+                               min(nb_real, bg.get_num_samples()), replace=False)
+        # sorted for the reads of memmaps and shards
+        ids.sort()
+        x, y = bg.get_images(ids), bg.dataset_y[ids]
         real = bg.ramdom_kshot_images(self.k_shot,
                                     np.full(size, bg.classes[0]))
 
@@ -1328,10 +1912,10 @@ class BalancingGAN:
 
         fake_labels = [np.full((size,), 'fake of 0')]
 
-        for classid in bg.classes[1:5]:
+        for code, classid in enumerate(bg.classes[1:5], 1):
             real = bg.ramdom_kshot_images(self.k_shot,
                                     np.full(size, classid))
-            fake = self.generate(real, self.generate_latent([classid] * size))
+            fake = self.generate(real, self.generate_latent([code] * size))
             fakes = np.concatenate([fakes, fake])
             fake_labels.append(np.full((size,), 'fake of {}'.format(classid)))
 
@@ -1347,7 +1931,9 @@ class BalancingGAN:
         except:
             print("can not draw fake real space")
         labels = np.concatenate([y, np.concatenate(fake_labels)])
-        utils.scatter_plot(imgs, labels, self.latent_encoder, 'latent encoder')
+        # codes of the real samples are cached, only the fakes are encoded
+        codes = np.concatenate([self.attribute_codes(bg)[ids], self.latent_code(fakes)])
+        utils.visualize_scatter(utils.decompose(codes), labels)
 
     def interval_process(self, epoch, interval = 20):
         if epoch % interval != 0:
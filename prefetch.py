@@ -0,0 +1,70 @@
+"""
+Background preparation of training step inputs.
+"""
+import queue
+import threading
+
+
+class Prefetcher:
+    """
+    Iterate over the inputs of nb_steps steps, prepared by a background
+    thread up to `depth` steps ahead.
+
+    produce(step, buf) fills the dict buf with the inputs of a step. Buffers
+    are recycled: a dict given back to produce still holds the arrays of an
+    older step, which can be reused as output buffers. The dict yielded for
+    a step is valid until the next one is requested.
+    """
+    def __init__(self, produce, nb_steps, depth=2):
+        """
+        depth: number of steps prepared ahead, 0 to prepare them inline
+        """
+        self.produce = produce
+        self.nb_steps = nb_steps
+        self.depth = depth
+
+    def __len__(self):
+        return self.nb_steps
+
+    def _inline(self):
+        buf = {}
+        for step in range(self.nb_steps):
+            self.produce(step, buf)
+            yield buf
+
+    def _work(self, free, ready, stop):
+        try:
+            for step in range(self.nb_steps):
+                buf = free.get()
+                if stop.is_set():
+                    return
+                self.produce(step, buf)
+                ready.put(buf)
+        except Exception as e:
+            ready.put(e)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            yield from self._inline()
+            return
+
+        # depth buffers ready or being filled, one used by the caller
+        free = queue.Queue()
+        for _ in range(self.depth + 1):
+            free.put({})
+        ready = queue.Queue()
+        stop = threading.Event()
+        worker = threading.Thread(target=self._work, args=(free, ready, stop),
+                                  daemon=True)
+        worker.start()
+        try:
+            for _ in range(self.nb_steps):
+                buf = ready.get()
+                if isinstance(buf, Exception):
+                    raise buf
+                yield buf
+                free.put(buf)
+        finally:
+            stop.set()
+            free.put({})
+            worker.join()
@@ -0,0 +1,290 @@
+"""
+Index samplers used by the batch generators.
+
+Every draw is done for a whole batch of labels at once with array
+operations, there is no per-sample python loop.
+"""
+import numpy as np
+
+
+class ClassIndex:
+    """
+    Sample ids grouped by class: ids of the class with code c are
+    order[offsets[c]:offsets[c + 1]], codes being positions in `classes`
+    """
+    def __init__(self, labels):
+        self.classes, self.codes = np.unique(np.asarray(labels), return_inverse=True)
+        self.order = np.argsort(self.codes, kind='stable')
+        self.counts = np.bincount(self.codes, minlength=len(self.classes))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+    def encode(self, labels):
+        """
+        Codes of the given label values
+        """
+        labels = np.asarray(labels)
+        codes = np.searchsorted(self.classes, labels)
+        known = codes < len(self.classes)
+        known[known] = self.classes[codes[known]] == labels[known]
+        if not known.all():
+            raise KeyError('Unknown labels {}'.format(np.unique(labels[~known])))
+        return codes
+
+    def class_ids(self, code):
+        return self.order[self.offsets[code]:self.offsets[code + 1]]
+
+    def _to_ids(self, codes, pos):
+        return self.order[self.offsets[codes][:, None] + pos]
+
+    def draw(self, labels, k=1):
+        """
+        k ids of the class of every label, drawn with replacement
+        return: (len(labels), k) ids
+        """
+        codes = self.encode(labels)
+        n = self.counts[codes][:, None]
+        pos = (np.random.random_sample((len(codes), k)) * n).astype(np.int64)
+        return self._to_ids(codes, pos)
+
+    def draw_distinct(self, labels, k):
+        """
+        k distinct ids of the class of every label, classes with less than
+        k samples are drawn with replacement
+        return: (len(labels), k) ids
+        """
+        codes = self.encode(labels)
+        n = self.counts[codes]
+        pos = np.empty((len(codes), k), dtype=np.int64)
+        # Floyd's algorithm, one column at a time for the whole batch
+        for j in range(k):
+            top = n - k + j
+            r = (np.random.random_sample(len(codes)) * (top + 1)).astype(np.int64)
+            if j > 0:
+                taken = (pos[:, :j] == r[:, None]).any(axis=1)
+                r = np.where(taken, top, r)
+            pos[:, j] = r
+
+        small = n < k
+        if small.any():
+            pos[small] = (np.random.random_sample((small.sum(), k))
+                          * n[small][:, None]).astype(np.int64)
+        return self._to_ids(codes, pos)
+
+    def other_labels(self, labels):
+        """
+        A label drawn uniformly among the other classes for every label
+        """
+        if len(self.classes) < 2:
+            raise ValueError('Negatives need samples of at least two classes, '
+                             'got {} class(es)'.format(len(self.classes)))
+        codes = self.encode(labels)
+        other = np.random.randint(0, len(self.classes) - 1, size=len(codes))
+        other += other >= codes
+        return self.classes[other]
+
+
+class EpochPlan:
+    """
+    Sample ids of a whole epoch drawn up front for a target class
+    distribution. Classes are spread evenly over the epoch so every batch
+    is close to the target distribution, batch i is the slice
+    [i * batch_size, (i + 1) * batch_size) of ids, labels, support and
+    negatives.
+    """
+    def __init__(self, index, batch_size, target=None, nb_samples=None,
+                 k_shot=0, negatives=False):
+        """
+        index: ClassIndex of the generator
+        target: None for the class distribution of the data, 'balanced' for
+                a uniform one, or a weight per class (an array in the order of
+                index.classes or a dict label -> weight)
+        nb_samples: samples in the epoch, default to the number of samples
+        k_shot: also draw k_shot support ids per sample
+        negatives: also draw one id of another class per sample, True for a
+                   uniform one or a function labels -> negative ids
+        """
+        self.batch_size = batch_size
+        if nb_samples is None:
+            nb_samples = len(index.codes)
+        self.nb_batches = nb_samples // batch_size
+        size = self.nb_batches * batch_size
+
+        counts = self._allocate(self.target_probs(index, target), size)
+        codes = np.repeat(np.arange(len(counts)), counts)
+        # spread every class evenly: sort on the rank within the class
+        # scaled by the class count, jittered to mix the classes
+        rank = np.arange(size) - np.repeat(np.cumsum(counts) - counts, counts)
+        key = (rank + np.random.random_sample(size)) / np.maximum(counts[codes], 1)
+        spread = np.argsort(key, kind='stable')
+
+        ids = np.empty(size, dtype=np.int64)
+        for c in np.where(counts > 0)[0]:
+            # go through the class without replacement, as many times as needed
+            class_ids = index.class_ids(c)
+            rounds = -(-counts[c] // len(class_ids))
+            pos = np.concatenate([np.random.permutation(len(class_ids))
+                                  for _ in range(rounds)])[:counts[c]]
+            ids[codes == c] = class_ids[pos]
+
+        self.ids = ids[spread]
+        self.labels = index.classes[codes[spread]]
+        self.support = index.draw_distinct(self.labels, k_shot) if k_shot else None
+        if callable(negatives):
+            self.negatives = negatives(self.labels)
+        elif negatives:
+            self.negatives = index.draw(index.other_labels(self.labels))[:, 0]
+        else:
+            self.negatives = None
+
+    @staticmethod
+    def target_probs(index, target):
+        if target is None:
+            probs = index.counts.astype(np.float64)
+        elif isinstance(target, str) and target == 'balanced':
+            probs = np.ones(len(index.classes))
+        elif isinstance(target, dict):
+            probs = np.array([target.get(c, 0) for c in index.classes], dtype=np.float64)
+        else:
+            probs = np.asarray(target, dtype=np.float64)
+        return probs / probs.sum()
+
+    @staticmethod
+    def _allocate(probs, size):
+        """
+        Integer counts summing to size, by largest remainder
+        """
+        exact = probs * size
+        counts = np.floor(exact).astype(np.int64)
+        rest = size - counts.sum()
+        counts[np.argsort(counts - exact, kind='stable')[:rest]] += 1
+        return counts
+
+    def __len__(self):
+        return self.nb_batches
+
+    def batch_slice(self, i):
+        return slice(i * self.batch_size, (i + 1) * self.batch_size)
+
+    def __iter__(self):
+        for i in range(self.nb_batches):
+            batch = self.batch_slice(i)
+            yield self.ids[batch], self.labels[batch]
+
+    def reorder(self, order):
+        """
+        Reorder the samples of the epoch, with their supports and negatives
+        order: permutation of the sample positions
+        """
+        self.ids = self.ids[order]
+        self.labels = self.labels[order]
+        if self.support is not None:
+            self.support = self.support[order]
+        if self.negatives is not None:
+            self.negatives = self.negatives[order]
+
+
+class HardNegativeIndex:
+    """
+    For every class, the `size` samples of the other classes nearest to the
+    class center in an embedding space. Negatives drawn from it are close
+    to the anchor class instead of uniform over the other classes.
+    The negatives are ranked against the center of the anchor class, not
+    against every anchor: all the anchors of a class share the same pool,
+    which keeps the index at (classes, size) ids.
+    """
+    def __init__(self, index, codes, size=64):
+        """
+        index: ClassIndex of the samples
+        codes: (N, d) embedding of every sample
+        """
+        self.index = index
+        nb_classes = len(index.classes)
+        size = min(size, len(codes) - index.counts.max())
+        if size < 1:
+            raise ValueError('Hard negatives need samples of at least two classes, '
+                             'got {} class(es)'.format(nb_classes))
+        codes = np.asarray(codes, dtype=np.float32)
+        centers = np.stack([codes[index.class_ids(c)].mean(axis=0)
+                            for c in range(nb_classes)])
+
+        # squared distances of every sample to every center, (C, N)
+        dist = (centers ** 2).sum(axis=1)[:, None] \
+            - 2 * centers.dot(codes.T) \
+            + (codes ** 2).sum(axis=1)[None, :]
+        dist[index.codes[None, :] == np.arange(nb_classes)[:, None]] = np.inf
+        self.table = np.argpartition(dist, size - 1, axis=1)[:, :size]
+
+    def draw(self, labels):
+        """
+        One hard negative id for every label
+        """
+        codes = self.index.encode(labels)
+        cols = np.random.randint(0, self.table.shape[1], size=len(codes))
+        return self.table[codes, cols]
+
+
+class LatentSampler:
+    """
+    Class conditional gaussian latent sampler. Every class covariance is
+    factorized once, a batch of latents takes one matmul per class.
+    """
+    def __init__(self, means, covariances):
+        self.means = np.asarray(means, dtype=np.float64)
+        self.factors = np.stack([self._factor(c) for c in covariances])
+
+    @staticmethod
+    def _factor(cov):
+        """
+        L such that L.dot(L.T) == cov
+        """
+        try:
+            return np.linalg.cholesky(cov)
+        except np.linalg.LinAlgError:
+            # singular covariance, e.g. fewer samples than dimensions
+            w, v = np.linalg.eigh(cov)
+            return v * np.sqrt(np.clip(w, 0, None))
+
+    def sample(self, labels):
+        """
+        One latent vector drawn from the distribution of every label
+        labels: class ids, indices of means
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        eps = np.random.standard_normal((len(labels), self.means.shape[1]))
+        res = np.empty_like(eps)
+        for c in np.unique(labels):
+            rows = labels == c
+            res[rows] = eps[rows].dot(self.factors[c].T) + self.means[c]
+        return res
+
+
+class AliasSampler:
+    """
+    Categorical sampler built with Walker's alias method: a draw is one
+    uniform column and one biased coin, a batch is drawn in O(size)
+    """
+    def __init__(self, probs, values=None):
+        """
+        probs: probability of every category, normalized here
+        values: value of every category, default to its index
+        """
+        probs = np.asarray(probs, dtype=np.float64)
+        nb = len(probs)
+        scaled = probs / probs.sum() * nb
+        self.prob = np.ones(nb)
+        self.alias = np.arange(nb)
+        small = [i for i in range(nb) if scaled[i] < 1.0]
+        large = [i for i in range(nb) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # the columns left are full up to rounding errors
+        self.values = np.arange(nb) if values is None else np.asarray(values)
+
+    def sample(self, size):
+        cols = np.random.randint(0, len(self.prob), size=size)
+        keep = np.random.random_sample(size) < self.prob[cols]
+        return self.values[np.where(keep, cols, self.alias[cols])]
@@ -0,0 +1,275 @@
+"""
+Local staging of artifacts stored under BASE_DIR.
+
+BASE_DIR usually points at a slow network mount. Files read from it are
+copied once to a local cache directory and checked against the sha1 of
+the copied stream, later reads use the local copy while the remote size
+and mtime are unchanged. Files are written to the local copy first and
+pushed back to the remote directory by a background thread. Pushes of a
+path run one at a time, a failed push is retried by the next fetch, push
+or flush of the path and its local copy is never overwritten meanwhile.
+
+Paths outside of the remote root are returned unchanged.
+"""
+import os
+import json
+import atexit
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logger
+from const import BASE_DIR, LOCAL_CACHE_DIR
+
+
+def _sha1(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy(src, dst, chunk_size=1 << 20):
+    """
+    Copy src to dst through a temporary file
+    return: sha1 of the copied content
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    digest = hashlib.sha1()
+    with open(src, 'rb') as fin, open(dst + '.tmp', 'wb') as fout:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            digest.update(chunk)
+            fout.write(chunk)
+    os.replace(dst + '.tmp', dst)
+    return digest.hexdigest()
+
+
+class Staging:
+    def __init__(self, remote_root, local_root, workers=2):
+        self.remote_root = os.path.abspath(remote_root)
+        self.local_root = os.path.abspath(local_root)
+        self._meta_root = os.path.join(self.local_root, '.stage')
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}
+        # paths whose last push failed, their local copy is ahead of the remote
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def local_path(self, path):
+        path = os.path.abspath(path)
+        if os.path.commonpath([path, self.remote_root]) != self.remote_root:
+            return path
+        return os.path.join(self.local_root,
+                            os.path.relpath(path, self.remote_root))
+
+    def _remote_path(self, local):
+        return os.path.join(self.remote_root,
+                            os.path.relpath(local, self.local_root))
+
+    def _meta_path(self, local):
+        return os.path.join(self._meta_root,
+                            os.path.relpath(local, self.local_root) + '.json')
+
+    def _read_meta(self, local):
+        try:
+            with open(self._meta_path(local), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_meta(self, local, remote, digest):
+        stat = os.stat(remote)
+        meta_path = self._meta_path(local)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        with open(meta_path, 'w') as f:
+            json.dump({
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha1': digest,
+                'local_mtime': os.stat(local).st_mtime,
+            }, f)
+
+    def _in_sync(self, local, remote):
+        """
+        True if neither the local copy nor the remote file changed since
+        they were last copied
+        """
+        meta = self._read_meta(local)
+        if meta is None or not os.path.exists(local) or not os.path.exists(remote):
+            return False
+        stat = os.stat(remote)
+        return meta['size'] == stat.st_size \
+            and meta['mtime'] == stat.st_mtime \
+            and meta['local_mtime'] == os.stat(local).st_mtime
+
+    @staticmethod
+    def _related(path, paths):
+        """
+        Paths of `paths` equal to path, inside it or containing it
+        """
+        return [
+            p for p in paths
+            if p == path or p.startswith(path + os.sep) or path.startswith(p + os.sep)
+        ]
+
+    def _wait(self, path):
+        """
+        Wait for the pushes of path in progress, so the local copy is not
+        read or written while it is being copied
+        """
+        with self._lock:
+            futures = [self._pending[p] for p in self._related(path, self._pending)]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    def _retry(self, path):
+        """
+        Push again the paths related to path whose last push failed
+        return: True if there were such paths
+        """
+        with self._lock:
+            failed = self._related(path, self._failed)
+        for p in failed:
+            self.push(p)
+        return len(failed) > 0
+
+    def _fetch_file(self, remote, local):
+        if self._in_sync(local, remote):
+            return
+        digest = _copy(remote, local)
+        if _sha1(local) != digest:
+            os.remove(local)
+            raise IOError('Checksum mismatch while staging {}'.format(remote))
+        self._write_meta(local, remote, digest)
+
+    def fetch(self, path):
+        """
+        Local path to read `path` from, copying it (a file or a whole
+        directory) from the remote directory when the local copy is missing
+        or out of date. A path missing on both sides is returned as its
+        local path so it can be created there.
+        """
+        local = self.local_path(path)
+        path = os.path.abspath(path)
+        if local == path:
+            return local
+        self._wait(path)
+        if self._retry(path):
+            # the local copy holds writes the remote directory does not have
+            return local
+
+        if os.path.isdir(path):
+            remote_files = set()
+            for root, _, files in os.walk(path):
+                for f in files:
+                    remote = os.path.join(root, f)
+                    remote_files.add(remote)
+                    self._fetch_file(remote, self.local_path(remote))
+            # drop staged copies of files removed from the remote directory
+            for root, _, files in os.walk(local):
+                for f in files:
+                    if f.endswith('.tmp'):
+                        continue
+                    staged = os.path.join(root, f)
+                    if self._remote_path(staged) not in remote_files \
+                            and self._read_meta(staged) is not None:
+                        os.remove(staged)
+                        os.remove(self._meta_path(staged))
+        elif os.path.exists(path):
+            self._fetch_file(path, local)
+        return local
+
+    def write_path(self, path):
+        """
+        Local path to write `path` to, call push once it is written.
+        Waits for the push of an older write of the path.
+        """
+        local = self.local_path(path)
+        self._wait(os.path.abspath(path))
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        return local
+
+    def _push(self, path, local, previous):
+        if previous is not None:
+            # copies the latest local version, whatever became of the previous push
+            try:
+                previous.result()
+            except Exception:
+                pass
+        if os.path.isdir(local):
+            for root, _, files in os.walk(local):
+                for f in files:
+                    if f.endswith('.tmp'):
+                        continue
+                    staged = os.path.join(root, f)
+                    remote = self._remote_path(staged)
+                    if not self._in_sync(staged, remote):
+                        self._write_meta(staged, remote, _copy(staged, remote))
+        else:
+            self._write_meta(local, path, _copy(local, path))
+
+    def push(self, path):
+        """
+        Copy the local version of `path` back to the remote directory in the background
+        """
+        local = self.local_path(path)
+        path = os.path.abspath(path)
+        if local == path:
+            return None
+        with self._lock:
+            self._failed.discard(path)
+            future = self._executor.submit(self._push, path, local,
+                                           self._pending.get(path))
+            self._pending[path] = future
+        future.add_done_callback(lambda f: self._done(path, f))
+        return future
+
+    def _done(self, path, future):
+        with self._lock:
+            if self._pending.get(path) is future:
+                del self._pending[path]
+                if future.exception() is not None:
+                    self._failed.add(path)
+        if future.exception() is not None:
+            logger.warn('Push of {} failed, it will be retried: {}'.format(
+                path, future.exception()))
+
+    def flush(self):
+        """
+        Retry the failed pushes and wait until every pushed file is written
+        to the remote directory
+        """
+        with self._lock:
+            failed = list(self._failed)
+        for path in failed:
+            self.push(path)
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+
+_default = Staging(BASE_DIR, LOCAL_CACHE_DIR)
+atexit.register(_default.flush)
+
+
+def fetch(path):
+    return _default.fetch(path)
+
+
+def write_path(path):
+    return _default.write_path(path)
+
+
+def push(path):
+    return _default.push(path)
+
+
+def flush():
+    _default.flush()
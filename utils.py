@@ -14,8 +14,13 @@ import re
 import numpy as np
 import datetime
 import pickle
+import hashlib
+import multiprocessing
 import cv2
 import urllib.request
+import logger
+import ds_store
+import staging
 from const import BASE_DIR
 
 
@@ -23,6 +28,9 @@ from google.colab.patches import cv2_imshow
 from PIL import Image
 DS_SAVE_DIR = BASE_DIR + '/dataset/save'
 DS_DIR = BASE_DIR + '/dataset/chest_xray'
+CHEST_CATEGORIES = ['NORMAL', 'PNEUMONIA']
+# resolutions saved together when the chest dataset is decoded
+CHEST_RESOLUTIONS = [32, 64, 128]
 import requests
 import json
 decomposers = {
@@ -69,12 +77,42 @@ def show_samples(img_array):
     )
     save_image_array(img_samples, None, True)
 
+def normalize(imgs, out=None):
+    """
+    Scale uint8 images to float32 in [-1, 1]
+    out: float32 array to write to, imgs is broadcast to its shape
+    """
+    if out is None:
+        imgs = np.array(imgs, dtype=np.float32)
+    else:
+        out[...] = imgs
+        imgs = out
+    imgs -= 127.5
+    imgs /= 127.5
+    return imgs
+
+def take_normalized(imgs, ids, chunk_size=1024):
+    """
+    Gather the rows `ids` of an uint8 image block into a normalized float32
+    array, without an intermediate uint8 copy of the whole selection
+    """
+    res = np.empty((len(ids),) + imgs.shape[1:], dtype=np.float32)
+    for start in range(0, len(ids), chunk_size):
+        res[start:start + chunk_size] = imgs[ids[start:start + chunk_size]]
+    res -= 127.5
+    res /= 127.5
+    return res
+
 def triple_channels(image):
+    """
+    3 channel version of grayscale images, as a read-only broadcast view:
+    the gray channel is not copied
+    """
     # axis = 2 for single image, 3 for many images
     if image.shape[-1] == 3:
         return image
 
-    return np.repeat(image, 3, axis = -1)
+    return np.broadcast_to(image, image.shape[:-1] + (3,))
 
 def pickle_save(object, path):
     try:
@@ -119,7 +157,7 @@ def add_padding(img):
     """
     Add black padding
     """
-    w, h, _ = img.shape
+    w, h = img.shape[:2]
     size = abs(w - h) // 2
     value= [0, 0, 0]
     if w < h:
@@ -130,86 +168,249 @@ def add_padding(img):
                                     cv2.BORDER_CONSTANT,
                                     value=value)
 
-def save_ds(imgs, rst, opt):
-    path = '{}/imgs_{}_{}.pkl'.format(DS_SAVE_DIR, opt, rst)
-    pickle_save(imgs, path)
-
-def load_ds(rst, opt):
-    path = '{}/imgs_{}_{}.pkl'.format(DS_SAVE_DIR, opt, rst)
-    return pickle_load(path)
+def read_padded_img(path, data=None):
+    """
+    Read an image as grayscale and pad it to a square
+    data: raw file content, read from path if None
+    """
+    if data is None:
+        data = np.fromfile(path, dtype=np.uint8)
+    img = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise IOError('can not read image')
+    return add_padding(img)
+
+def resize_img(img, rst):
+    """
+    Resize a padded source image, every stored resolution goes through here
+    so its pixels do not depend on how the store was built
+    """
+    return cv2.resize(img, (rst, rst))
 
 def get_img(path, rst):
-    img = cv2.imread(path)
-    img = add_padding(img)
-    img = cv2.resize(img, (rst, rst))
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    return np.expand_dims(img, axis=0)
-    return img.tolist()
+    """
+    Read an image as grayscale, pad it to a square and resize
+    return: uint8 array with shape (rst, rst)
+    """
+    return resize_img(read_padded_img(path), rst)
 
-def load_train_data(resolution=52):
-    labels = []
-    imgs = []
-    i = 0
-    res = load_ds(resolution, 'train')
-    if res:
-        return res
-
-    for file in os.listdir(DS_DIR + '/train/NORMAL'):
-        path = DS_DIR + '/train/NORMAL/' + file
-        i += 1
-        if i % 150 == 0:
-            print(len(labels), end=',')
-        try:
-            imgs.append(get_img(path, resolution))
-            labels.append(0)
-        except:
-            pass
-
-    for file in os.listdir(DS_DIR + '/train/PNEUMONIA'):
-        path = DS_DIR + '/train/PNEUMONIA/' + file
-        i += 1
-        if i % 150 == 0:
-            print(len(labels), end=',')
+def _decode_shard(shard):
+    """
+    Worker of decode_images, decode a contiguous slice of the file list
+    once and resize it to every resolution
+    """
+    start, paths, resolutions = shard
+    imgs = {
+        rst: np.zeros((len(paths), rst, rst), dtype=np.uint8)
+        for rst in resolutions
+    }
+    decoded = np.zeros(len(paths), dtype=bool)
+    digests = [None] * len(paths)
+    failures = []
+    for i, path in enumerate(paths):
         try:
-            imgs.append(get_img(path, resolution))
-            labels.append(1)
-        except:
-            pass
-
-    # channel last
-    imgs = np.array(imgs)
-    imgs = np.reshape(imgs, (imgs.shape[0], resolution, resolution, 1)) # grayscale
-    res = (imgs, np.array(labels))
-    save_ds(res, resolution, 'train')
-    return res
-
-def load_test_data(resolution = 52):
-    imgs = []
+            data = np.fromfile(path, dtype=np.uint8)
+            digests[i] = hashlib.sha1(data).hexdigest()
+            img = read_padded_img(path, data)
+            for rst in resolutions:
+                imgs[rst][i] = resize_img(img, rst)
+            decoded[i] = True
+        except Exception as e:
+            failures.append((path, str(e)))
+    return start, imgs, decoded, digests, failures
+
+def decode_images(paths, resolutions, workers=None, shard_size=64):
+    """
+    Decode images in parallel with a process pool.
+    The file list is split into shards of `shard_size` files, each shard is
+    written back at its own offset so the output order follows `paths`.
+    Every image is decoded once and resized to all `resolutions`.
+    return: ({rst: uint8 array (N, rst, rst, 1)}, bool mask of decoded files,
+            sha1 of every file, failures)
+    """
+    imgs = {
+        rst: np.zeros((len(paths), rst, rst, 1), dtype=np.uint8)
+        for rst in resolutions
+    }
+    decoded = np.zeros(len(paths), dtype=bool)
+    digests = [None] * len(paths)
+    failures = []
+    shards = [
+        (start, paths[start:start + shard_size], resolutions)
+        for start in range(0, len(paths), shard_size)
+    ]
+    done = 0
+    with multiprocessing.Pool(workers) as pool:
+        for start, shard_imgs, shard_decoded, shard_digests, shard_failures in \
+                pool.imap_unordered(_decode_shard, shards):
+            end = start + len(shard_decoded)
+            for rst in resolutions:
+                imgs[rst][start:end, :, :, 0] = shard_imgs[rst]
+            decoded[start:end] = shard_decoded
+            digests[start:end] = shard_digests
+            failures.extend(shard_failures)
+            done += len(shard_decoded)
+            print(done, end=',')
+    print()
+
+    for path, err in failures:
+        logger.warn('Can not decode {}: {}'.format(path, err))
+    return imgs, decoded, digests, failures
+
+def file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def list_chest_files(opt):
+    """
+    List the image files of a chest split in a deterministic order
+    return: (paths, labels)
+    """
+    paths = []
     labels = []
-    res = load_ds(resolution, 'test')
-    if res:
-        return res
-    for file in os.listdir(DS_DIR + '/test/NORMAL'):
-        path = DS_DIR + '/test/NORMAL/' + file
-        try:
-            imgs.append(get_img(path, resolution))
-            labels.append(0)
-        except:
-            pass
+    for label, category in enumerate(CHEST_CATEGORIES):
+        folder = '{}/{}/{}'.format(DS_DIR, opt, category)
+        files = sorted(os.listdir(folder))
+        paths += [folder + '/' + f for f in files]
+        labels += [label] * len(files)
+    return paths, np.array(labels)
+
+def chest_store_path(opt):
+    return '{}/chest_{}'.format(DS_SAVE_DIR, opt)
+
+def _manifest_entry(path, label, digest):
+    stat = os.stat(path)
+    return {
+        'path': os.path.relpath(path, DS_DIR),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha1': digest,
+        'label': int(label),
+    }
+
+def _decode_chest_files(paths, labels, resolutions):
+    """
+    return: ({rst: images}, labels, manifest entries) of the decoded files
+    """
+    imgs, decoded, digests, _ = decode_images(paths, resolutions)
+    entries = [
+        _manifest_entry(path, label, digest)
+        for path, label, digest, ok in zip(paths, labels, digests, decoded) if ok
+    ]
+    for rst in resolutions:
+        if not decoded.all():
+            imgs[rst] = imgs[rst][decoded]
+    return imgs, np.asarray(labels, dtype=np.int64)[decoded], entries
+
+def build_chest_store(opt, resolutions=CHEST_RESOLUTIONS):
+    """
+    Decode a chest split once and save every resolution in the same store
+    """
+    paths, labels = list_chest_files(opt)
+    # channel last, grayscale
+    imgs, labels, entries = _decode_chest_files(paths, labels, resolutions)
+    path = staging.write_path(chest_store_path(opt))
+    ds_store.write_labels(path, labels)
+    for rst in resolutions:
+        ds_store.write_images(path, imgs.pop(rst))
+    ds_store.write_manifest(path, entries)
+    staging.push(chest_store_path(opt))
+    return ds_store.DatasetStore(path)
+
+def add_chest_resolution(store, rst):
+    """
+    Add a resolution to an up to date chest store, its source files are
+    decoded again so the block matches the ones decoded with the store
+    """
+    paths = [os.path.join(DS_DIR, entry['path'])
+             for entry in ds_store.read_manifest(store.path)]
+    logger.info('Add resolution {} to chest store {}'.format(rst, store.path))
+    imgs, decoded, _, _ = decode_images(paths, [rst])
+    if not decoded.all():
+        raise IOError('Can not decode every source file of {}, rebuild it with '
+                      'build_chest_store'.format(store.path))
+    ds_store.write_images(store.path, imgs[rst])
+
+def update_chest_store(opt, resolution):
+    """
+    Bring the chest store of a split up to date with its source folders.
+    Rows of unchanged files are kept, added or changed files are decoded and
+    appended, rows of removed files are dropped.
+    A file is unchanged when its size and mtime match the manifest, or when
+    its content hash does.
+    """
+    path = staging.fetch(chest_store_path(opt))
+    ds_store.recover_store(path)
+    manifest = ds_store.read_manifest(path) if ds_store.has_store(path) else None
+    if manifest is None:
+        return build_chest_store(opt, sorted(set(CHEST_RESOLUTIONS + [resolution])))
+
+    store = ds_store.DatasetStore(path)
+    resolutions = store.resolutions()
+    if resolution > max(resolutions):
+        return build_chest_store(opt, sorted(set(resolutions + [resolution])))
+
+    known = {entry['path']: (row, entry) for row, entry in enumerate(manifest)}
+    to_keep, entries = [], []
+    to_decode, decode_labels = [], []
+    touched = False
+    for src, label in zip(*list_chest_files(opt)):
+        row, entry = known.get(os.path.relpath(src, DS_DIR), (None, None))
+        if entry is not None and entry['label'] == label:
+            stat = os.stat(src)
+            if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                to_keep.append(row)
+                entries.append(entry)
+                continue
+            if entry['sha1'] == file_sha1(src):
+                to_keep.append(row)
+                entries.append(dict(entry, size=stat.st_size, mtime=stat.st_mtime))
+                touched = True
+                continue
+        to_decode.append(src)
+        decode_labels.append(label)
+
+    unchanged = len(to_decode) == 0 and to_keep == list(range(len(manifest)))
+    if not unchanged:
+        logger.info('Update chest store {}: keep {}, decode {}, drop {}'.format(
+            path, len(to_keep), len(to_decode), len(manifest) - len(to_keep)))
+        to_keep = np.array(to_keep, dtype=np.int64)
+        if to_decode:
+            imgs, new_labels, new_entries = _decode_chest_files(to_decode,
+                                                                decode_labels,
+                                                                resolutions)
+        else:
+            # only removed files, no decode pool needed
+            imgs = {rst: np.zeros((0, rst, rst, 1), dtype=np.uint8)
+                    for rst in resolutions}
+            new_labels, new_entries = np.zeros(0, dtype=np.int64), []
+        ds_store.update_store(path, to_keep, imgs, new_labels, entries + new_entries)
+    elif touched:
+        ds_store.write_manifest(path, entries)
+
+    store = ds_store.DatasetStore(path)
+    if resolution not in store.resolutions():
+        add_chest_resolution(store, resolution)
+        unchanged = False
+    if touched or not unchanged:
+        staging.push(chest_store_path(opt))
+    return store
+
+def _read_chest_data(resolution, opt):
+    # the store and its manifest are the source of truth, legacy
+    # imgs_{opt}_{rst}.pkl files are not read anymore
+    store = update_chest_store(opt, resolution)
+    return np.array(store.images(resolution)), store.labels
+
+def _load_chest_data(resolution, opt):
+    return ds_store.shared((chest_store_path(opt), resolution),
+                           lambda: _read_chest_data(resolution, opt))
 
-    for file in os.listdir(DS_DIR + '/test/PNEUMONIA'):
-        path = DS_DIR + '/test/PNEUMONIA/' + file
-        try:
-            imgs.append(get_img(path, resolution))
-            labels.append(1)
-        except:
-            pass
-    # channel last
-    imgs = np.array(imgs)
-    imgs = np.reshape(imgs, (imgs.shape[0], resolution, resolution, 1)) # grayscale
-    res = (imgs, np.array(labels))
-    save_ds(res, resolution, 'test')
-    return res
+def load_train_data(resolution=52):
+    return _load_chest_data(resolution, 'train')
+
+def load_test_data(resolution = 52):
+    return _load_chest_data(resolution, 'test')
 
 
 def pred2bin(pred):
@@ -253,15 +454,21 @@ def visualize_scatter(data_2d, label_ids, figsize=(8,8)):
     plt.legend(loc='best')
     plt.show()
 
+def decompose(x_embeddings, opt='pca'):
+    """
+    2d projection of embeddings
+    """
+    if len(x_embeddings.shape) > 2:
+        x_embeddings = x_embeddings.reshape(x_embeddings.shape[0], -1)
+    return decomposers[opt].fit_transform(x_embeddings)
+
 def scatter_plot(x, y, encoder, name='chart', opt='pca', plot_img=None):
     step = 1
     if encoder.input_shape[-1] != x.shape[-1]:
         x = triple_channels(x)
 
     x_embeddings = encoder.predict(x)
-    if len(x_embeddings.shape) > 2:
-        x_embeddings = x_embeddings.reshape(x_embeddings.shape[0], -1)
-    decomposed_embeddings = decomposers[opt].fit_transform(x_embeddings)
+    decomposed_embeddings = decompose(x_embeddings, opt)
     if plot_img:
         return visualize_scatter_with_images(decomposed_embeddings,x)
     visualize_scatter(decomposed_embeddings, y)
@@ -299,22 +506,25 @@ def group_k_images(image_list):
     return np.array(image_list)
 
 
+def prune_ids(y, prune_classes):
+    """
+    Ids of the samples kept after removing prune_classes[c] random samples of class c
+    """
+    keep = np.ones(len(y), dtype=bool)
+    for class_to_prune, remove_size in enumerate(prune_classes):
+        ids_c = np.where(y == class_to_prune)[0]
+        np.random.shuffle(ids_c)
+        keep[ids_c[:remove_size]] = False
+        print('Remove {} items in class {}'.format(remove_size, class_to_prune))
+    return np.where(keep)[0]
+
+
 def prune(x, y, prune_classes):
     """
     prune data by give classes
     """
-    for class_to_prune in range(len(prune_classes)):
-        print(class_to_prune)
-        remove_size = prune_classes[class_to_prune]
-        all_ids = list(np.arange(len(x)))
-        mask = [lc == class_to_prune for lc in y]
-        all_ids_c = np.array(all_ids)[mask]
-        np.random.shuffle(all_ids_c)
-        to_delete  = all_ids_c[:remove_size]
-        x = np.delete(x, to_delete, axis=0)
-        y = np.delete(y, to_delete, axis=0)
-        print('Remove {} items in class {}'.format(remove_size, class_to_prune))
-    return x, y
+    to_keep = prune_ids(y, prune_classes)
+    return x[to_keep], y[to_keep]
 
 
 def encode(msg):